@@ -152,6 +152,18 @@ style = '''
 
 enable_disk_cache = True
 
+# seconds to wait on the web process (link hints, view source, etc.) before
+# giving up on it.
+webprocess_timeout = 10
+
+# seconds to spend hinting on-screen elements before the follow prompt shows.
+# The rest of the page is hinted once the prompt is up.
+hint_time_budget = 0.05
+
+# view-source pages larger than this many characters are shown as plain text
+# rather than syntax highlighted.
+view_source_highlight_limit = 1024 * 1024
+
 # enable frame flattening to make pages with frames easier to navigate.
 enable_frame_flattening = True
 
@@ -189,3 +201,7 @@ def search_url(text):
         return
     else:
         return url.format(quote_plus(search))
+
+# rank prompt completions by fuzzy matching (typed characters appear in order,
+# not necessarily next to each other) instead of prefix or substring matching.
+fuzzy_completion = False
@@ -1,19 +1,24 @@
 #!/usr/bin/env python3
 
+import asyncio
 import base64
 import code
 import collections
+import concurrent.futures
 import datetime
 import faulthandler
-import fnmatch
 import functools
+import hashlib
 import html
 import itertools
+import json
+import multiprocessing
 import os
 import pathlib
 import random
 import shlex
 import threading
+import time
 from urllib import parse as urlparse
 
 import logbook
@@ -24,7 +29,8 @@ from gi.repository import GObject, Gdk, Gio, Gtk, Pango, GLib, WebKit2, GdkPixbu
 
 from .api import Mode
 from .utils import (
-    cache_path, config_path, runtime_path, get_keyname, get_pretty_size, init_logging, load_config, RolandConfigBase)
+    cache_path, config_path, runtime_path, get_keyname, get_pretty_size, highlight_source, init_logging, load_config,
+    run_steps, CompletionIndex, RolandConfigBase, RESPONSE_ERROR, RESPONSE_CHUNK)
 
 
 faulthandler.enable()
@@ -62,45 +68,274 @@ def private(func):
     return func
 
 
+class Command(collections.namedtuple('Command', 'name attr func private extensions')):
+    """A command for the command prompt.
+
+    Commands defined on BrowserCommands are looked up on the browser by
+    attribute name, so BrowserView subclasses can override them. Commands
+    registered by extensions have no attribute and are called with the
+    browser as their first argument.
+    """
+    def bind(self, browser):
+        if self.attr is not None:
+            return getattr(browser, self.attr)
+        return functools.partial(self.func, browser)
+
+    @property
+    def help(self):
+        return getattr(self.func, '__doc__', None) or 'No help available'
+
+
+def command_registry(cls):
+    """Map command names, as set with @rename, to the commands defined on
+    cls."""
+    commands = {}
+    for attr in dir(cls):
+        if attr.startswith('__'):
+            continue
+        func = getattr(cls, attr)
+        name = getattr(func, '__name__', attr)
+        commands[name] = Command(
+            name, attr, func, getattr(func, 'private', False), getattr(func, 'extensions', ()))
+    return commands
+
+
 request_counter = itertools.count(1)
+webprocess_channels = {}
+
 
+class WebProcessError(Exception):
+    pass
 
-def message_webprocess(command, *, page_id, profile, callback, **kwargs):
-    # FIXME: make this whole thing asyncio friendly, getting rid of callback
-    # and everything..
 
-    request_id = next(request_counter)
-    p = runtime_path('webprocess.{{}}.{}'.format(page_id), profile)
-    addr = Gio.UnixSocketAddress.new(p)
-    client = Gio.SocketClient.new()
+class WebProcessChannel:
+    """Long-lived connection to the web extension server of a web process,
+    shared by every page that process hosts.
 
-    unpacker = msgpack.Unpacker()
+    Requests are written as msgpack frames of
+    [request_id, page_id, command, params], so any number of them can be in
+    flight on the one socket. Response frames are passed back to the
+    respond(status, payload) callback of their request by request id.
 
-    def connect_callback(obj, result, user_data):
-        conn = client.connect_finish(result)
-        ostream = conn.get_output_stream()
+    Writes are asynchronous, one frame at a time, from a send queue of at most
+    `max_queued` requests. A web process that stops reading fails its own
+    requests once the queue fills, rather than blocking the main loop.
+    """
 
-        # FIXME: make write async
-        r = msgpack.dumps([request_id, command, kwargs])
-        ostream.write_bytes(GLib.Bytes(r))
+    def __init__(self, path, max_queued=64):
+        self.path = path
+        self.max_queued = max_queued
+        self.conn = None
+        self.pending = {}
+        self.queue = collections.deque()
+        self.writing = False
+        self.unpacker = msgpack.Unpacker(raw=True)
+
+        client = Gio.SocketClient.new()
+        client.connect_async(
+            Gio.UnixSocketAddress.new(path), None, self.on_connected, client)
+
+    def request(self, page_id, command, respond, **kwargs):
+        if len(self.queue) >= self.max_queued:
+            raise WebProcessError('Web process is not accepting requests')
+
+        request_id = next(request_counter)
+        self.pending[request_id] = respond
+
+        frame = msgpack.dumps([request_id, page_id, command, kwargs])
+        self.queue.append((request_id, frame))
+        self.write()
+        return request_id
+
+    def cancel(self, request_id):
+        self.pending.pop(request_id, None)
+
+        # no point sending it if it hasn't gone out yet.
+        for i, (queued_id, frame) in enumerate(self.queue):
+            if queued_id == request_id:
+                if not (i == 0 and self.writing):
+                    del self.queue[i]
+                break
+
+    def write(self):
+        if self.conn is None or self.writing or not self.queue:
+            return
 
-        istream = conn.get_input_stream()
-        istream.read_bytes_async(8192, 1, None, read_callback, conn)
+        self.writing = True
+        request_id, frame = self.queue[0]
+        ostream = self.conn.get_output_stream()
+        ostream.write_bytes_async(
+            GLib.Bytes(frame), GLib.PRIORITY_DEFAULT, None, self.on_written, None)
 
-    def read_callback(obj, result, conn):
-        istream = conn.get_input_stream()
-        bytes = istream.read_bytes_finish(result)
-        if not bytes.get_data():
-            conn.close(None)
+    def on_written(self, ostream, result, user_data):
+        self.writing = False
 
-            response_id, notes = unpacker.unpack()
-            if callback is not None:
-                callback(notes)
-        else:
-            unpacker.feed(bytes.get_data())
-            istream.read_bytes_async(8192, 1, None, read_callback, conn)
+        try:
+            written = ostream.write_bytes_finish(result)
+        except GLib.Error as e:
+            self.close("Error writing to web process: {}".format(e.message))
+            return
+
+        if self.conn is None:
+            return  # closed while the write was in progress
+
+        request_id, frame = self.queue.popleft()
+        if written < len(frame):
+            self.queue.appendleft((request_id, frame[written:]))
+        self.write()
+
+    def read(self):
+        istream = self.conn.get_input_stream()
+        istream.read_bytes_async(
+            64*1024, GLib.PRIORITY_DEFAULT, None, self.on_read, None)
+
+    def on_connected(self, client, result, user_data):
+        try:
+            self.conn = client.connect_finish(result)
+        except GLib.Error as e:
+            self.close("Could not connect to web process: {}".format(e.message))
+            return
+
+        self.write()
+        self.read()
+
+    def on_read(self, istream, result, user_data):
+        try:
+            data = istream.read_bytes_finish(result).get_data()
+        except GLib.Error as e:
+            self.close("Error reading from web process: {}".format(e.message))
+            return
+
+        if not data:
+            self.close("Web process closed the connection")
+            return
+        elif self.conn is None:
+            return  # closed while the read was in progress
+
+        self.unpacker.feed(data)
+        for request_id, status, payload in self.unpacker:
+            if status == RESPONSE_CHUNK:
+                respond = self.pending.get(request_id)
+            else:
+                respond = self.pending.pop(request_id, None)
+
+            if respond is None:
+                continue  # timed out or cancelled
+            elif status == RESPONSE_ERROR:
+                payload = payload.decode('utf8')
+            respond(status, payload)
+        self.read()
+
+    def close(self, reason):
+        log.info("Closing channel to {}: {}", self.path, reason)
+
+        if webprocess_channels.get(self.path) is self:
+            del webprocess_channels[self.path]
+
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            try:
+                conn.close(None)
+            except GLib.Error:
+                pass  # outstanding reads/writes will error out on their own
+
+        pending, self.pending = self.pending, {}
+        for respond in pending.values():
+            respond(RESPONSE_ERROR, reason)
+        self.queue.clear()
+
+
+class WebProcess:
+    """Awaitable interface to the web extension serving a page. Any attribute
+    is a coroutine function running the web extension command of that name,
+    e.g.
 
-    client.connect_async(addr, None, connect_callback, None)
+        notes = await roland.webprocess(page_id).highlight(selector='a')
+
+    Requests that get no response within `timeout` seconds raise
+    asyncio.TimeoutError, and failed requests raise WebProcessError.
+    """
+
+    def __init__(self, profile, page_id, timeout=None, max_queued=64):
+        self.profile = profile
+        self.page_id = page_id
+        self.timeout = timeout
+        self.max_queued = max_queued
+
+    def get_channel(self):
+        # the page's socket is a link to the one its web process listens on.
+        path = runtime_path('webprocess.{{}}.{}'.format(self.page_id), self.profile)
+        path = os.path.realpath(path)
+
+        channel = webprocess_channels.get(path)
+        if channel is None:
+            channel = webprocess_channels[path] = WebProcessChannel(
+                path, max_queued=self.max_queued)
+        return channel
+
+    async def request(self, command, **kwargs):
+        future = asyncio.get_event_loop().create_future()
+
+        def respond(status, payload):
+            if future.done():
+                return
+            elif status == RESPONSE_ERROR:
+                future.set_exception(WebProcessError(payload))
+            else:
+                future.set_result(payload)
+
+        channel = self.get_channel()
+        request_id = channel.request(self.page_id, command, respond, **kwargs)
+
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            # stop a timed out or cancelled request from lingering forever.
+            channel.cancel(request_id)
+
+    async def stream(self, command, **kwargs):
+        """Asynchronously iterate over the chunks of a streamed response. The
+        timeout applies to each chunk rather than the whole response."""
+        frames = asyncio.Queue()
+
+        def respond(status, payload):
+            frames.put_nowait((status, payload))
+
+        channel = self.get_channel()
+        request_id = channel.request(self.page_id, command, respond, **kwargs)
+
+        try:
+            while True:
+                status, payload = await asyncio.wait_for(frames.get(), self.timeout)
+
+                if status == RESPONSE_CHUNK:
+                    yield payload
+                elif status == RESPONSE_ERROR:
+                    raise WebProcessError(payload)
+                else:
+                    return
+        finally:
+            channel.cancel(request_id)
+
+    def __getattr__(self, command):
+        if command.startswith('_'):
+            raise AttributeError(command)
+        return functools.partial(self.request, command)
+
+
+def spawn(coro):
+    """Run a coroutine in the background, logging any errors it raises."""
+    def done(task):
+        try:
+            task.result()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            log.exception("Error in background task {}", task)
+
+    task = asyncio.ensure_future(coro)
+    task.add_done_callback(done)
+    return task
 
 
 class BrowserCommands:
@@ -181,58 +416,41 @@ class BrowserCommands:
             }
             ext.save_form(domain, form, description=description)
 
-            message_webprocess(
-                'form_fill',
-                profile=self.roland.profile,
-                page_id=self.webview.get_page_id(),
-                callback=None,
-                **{k.decode('utf8'): v for (k, v) in form.items()}
-            )
+            spawn(self.get_webprocess().form_fill(**form))
 
     @requires('PasswordManagerExtension')
     @rename('form-save')
     def form_save(self):
-        forms = {}
         ext = self.roland.get_extension('PasswordManagerExtension')
 
-        def serialised_form(form):
-            self.remove_overlay()
-
-            domain = urlparse.urlparse(self.webview.get_uri()).netloc
+        # unlock up front, blocking prompts can't run inside a coroutine.
+        try:
+            ext.unlock(self)
+        except ValueError:
+            self.roland.notify('Could not save form')
+            return
 
-            try:
-                ext.unlock(self)
-            except ValueError:
-                self.roland.notify('Could not save form')
-            else:
-                ext.save_form(domain, form)
+        async def form_save():
+            webprocess = self.get_webprocess()
 
-        def display_choices(choices):
-            forms.update(choices)
-            result = self.entry_line.blocking_prompt(
+            forms = await webprocess.highlight(selector='form')
+            result = await self.entry_line.wait_for_prompt(
                 prompt='Select form to save',
                 suggestions=sorted(k.decode('utf8') for k in forms.keys()),
                 force_match=True,
             )
             if result is None:
+                await webprocess.remove_overlay()
                 return
+
             form_id = forms[result.encode('utf8')].decode('utf8')
+            form = await webprocess.serialise_form(form_id=form_id)
+            await webprocess.remove_overlay()
 
-            message_webprocess(
-                'serialise_form',
-                form_id=form_id,
-                profile=self.roland.profile,
-                page_id=self.webview.get_page_id(),
-                callback=serialised_form,
-            )
+            domain = urlparse.urlparse(self.webview.get_uri()).netloc
+            ext.save_form(domain, form)
 
-        message_webprocess(
-            'highlight',
-            selector='form',
-            profile=self.roland.profile,
-            page_id=self.webview.get_page_id(),
-            callback=display_choices,
-        )
+        spawn(form_save())
 
     @requires('PasswordManagerExtension')
     @rename('form-fill')
@@ -270,13 +488,8 @@ class BrowserCommands:
 
         ext.update_last_used(choice.id)
 
-        message_webprocess(
-            'form_fill',
-            profile=self.roland.profile,
-            page_id=self.webview.get_page_id(),
-            callback=None,
-            **{k.decode('utf8'): v for (k, v) in form_data.items()}
-        )
+        spawn(self.get_webprocess().form_fill(
+            **{k.decode('utf8'): v for (k, v) in form_data.items()}))
 
     @private
     def select_window(self, selected=None):
@@ -468,39 +681,43 @@ class BrowserCommands:
 
     @rename('view-source')
     def view_source(self):
-        def have_source(source):
-            html = source[b'html'].decode('utf8')
-
+        async def view_source():
             uri = self.webview.get_uri()
 
-            try:
-                import pygments
-                import pygments.lexers
-                import pygments.formatters
-            except ImportError:
-                self.roland.new_window(uri, text=html)
-            else:
-                lexer = pygments.lexers.HtmlLexer()
-                formatter = pygments.formatters.HtmlFormatter(
-                    full=True, linenos='table')
-                highlighted = pygments.highlight(html, lexer, formatter)
-                self.roland.new_window(uri, html=highlighted)
-
-        message_webprocess(
-            'get_source',
-            profile=self.roland.profile,
-            page_id=self.webview.get_page_id(),
-            callback=have_source
-        )
+            # show the source as plain text while it streams in, highlighting
+            # it once it's all here.
+            window = None
+            source = []
+
+            chunks = self.get_webprocess().stream('get_source', chunk_size=64*1024)
+            async for chunk in chunks:
+                text = chunk[b'html'].decode('utf8')
+                source.append(text)
+
+                if window is None:
+                    window = self.roland.open_text_window(text)
+                else:
+                    window.append_text(text)
+
+            if window is None:
+                return
+
+            highlighted = await self.roland.highlight_source(''.join(source))
+            if highlighted is not None:
+                # the highlighted page has all the source already, plain text
+                # still waiting on the first load mustn't be added to it
+                window.pending_text = []
+                window.webview.load_html(highlighted, uri)
+
+        spawn(view_source())
+
+    @private
+    def get_webprocess(self):
+        return self.roland.webprocess(self.webview.get_page_id())
 
     @private
     def remove_overlay(self):
-        message_webprocess(
-            'remove_overlay',
-            profile=self.roland.profile,
-            page_id=self.webview.get_page_id(),
-            callback=None,
-        )
+        spawn(self.get_webprocess().remove_overlay())
 
     @rename('yank-links')
     @requires('ClipboardManager')
@@ -511,13 +728,7 @@ class BrowserCommands:
             except KeyError:
                 self.remove_overlay()
             else:
-                message_webprocess(
-                    'yank',
-                    yank_id=yank_id,
-                    profile=self.roland.profile,
-                    page_id=self.webview.get_page_id(),
-                    callback=None
-                )
+                spawn(self.get_webprocess().yank(yank_id=yank_id))
 
         return self.follow(open_callback=yank_link, selector='a[href]', prompt='Yank Link')
 
@@ -529,30 +740,35 @@ class BrowserCommands:
             except KeyError:
                 self.remove_overlay()
             else:
-                message_webprocess(
-                    'click',
-                    click_id=click_id,
-                    new_window=new_window,
-                    profile=self.roland.profile,
-                    page_id=self.webview.get_page_id(),
-                    callback=None
-                )
-
-        def display_choices(choices):
+                spawn(self.get_webprocess().click(
+                    click_id=click_id, new_window=new_window))
+
+        def get_suggestions(click_map):
+            return sorted([
+                s.decode('utf8').replace('\n', ' ')
+                for s in click_map.keys()], key=lambda s: int(s.split(':')[0]))
+
+        async def follow():
             nonlocal prompt
 
-            click_map.update(choices)
+            # hint what's on screen first, and the rest of the page after the
+            # prompt is up.
+            webprocess = self.get_webprocess()
+            click_map = await webprocess.highlight(selector=selector, viewport=True)
 
             if new_window:
                 prompt += ' (new window)'
-            suggestions = sorted([
-                s.decode('utf8').replace('\n', ' ')
-                for s in click_map.keys()], key=lambda s: int(s.split(':')[0]))
+            callback = functools.partial(open_callback or open_link, click_map)
             self.entry_line.prompt(
-                functools.partial(open_callback or open_link, click_map), prompt=prompt, cancel=self.remove_overlay,
-                suggestions=suggestions, force_match=True, beginning=False)
+                callback, prompt=prompt, cancel=self.remove_overlay,
+                suggestions=get_suggestions(click_map), force_match=True, beginning=False)
 
-        click_map = {}
+            async for rest in webprocess.stream('highlight_rest'):
+                if self.entry_line.callback is not callback:
+                    break
+
+                click_map.update(rest)
+                self.entry_line.add_suggestions(get_suggestions(rest))
 
         if selector is not None:
             pass
@@ -561,13 +777,7 @@ class BrowserCommands:
         else:
             selector = "a, input:not([type=hidden]), textarea, select, button"
 
-        message_webprocess(
-            'highlight',
-            selector=selector,
-            profile=self.roland.profile,
-            page_id=self.webview.get_page_id(),
-            callback=display_choices,
-        )
+        spawn(follow())
 
         return True
 
@@ -823,6 +1033,13 @@ class BrowserCommands:
 
 
 class EntryLine(Gtk.VBox):
+    # number of completions shown above the prompt
+    completion_limit = 20
+    # milliseconds typing has to pause for before completions are filtered
+    completion_delay = 30
+    # seconds to spend filtering completions per main loop iteration
+    completion_budget = 0.01
+
     def __init__(self, status_line, browser, font):
         Gtk.VBox.__init__(self)
 
@@ -847,12 +1064,29 @@ class EntryLine(Gtk.VBox):
 
         self.pack_end(self.input_container, False, False, 0)
 
+        # completions are shown in a fixed set of labels that are re-texted
+        # as the matches change, top to bottom in match order
+        self.matches = []
+        self.completion_source = None
+        self.completion_steps = None
+        self.index_source = None
+        self.completion_labels = []
+        for i in range(self.completion_limit):
+            l = Gtk.Label()
+            l.set_alignment(0.0, 0.5)
+            l.modify_font(font)
+            l.set_no_show_all(True)
+            self.completion_labels.append(l)
+        for l in reversed(self.completion_labels):
+            self.pack_end(l, False, False, 0)
+
     def completion(self, forward=True):
+        self.flush_completions()
         if not self.lock_suggestions:
             self.lock_suggestions = True
             self.position = -1
 
-        labels = [l.get_text() for l in self.get_children() if isinstance(l, Gtk.Label)]
+        labels = self.matches
 
         if forward:
             self.position = self.position + 1
@@ -873,8 +1107,7 @@ class EntryLine(Gtk.VBox):
             return
         self.lock_suggestions = False
 
-        self.remove_completions()
-        self.add_completions()
+        self.schedule_completions()
 
         return False
 
@@ -897,17 +1130,37 @@ class EntryLine(Gtk.VBox):
 
         return result
 
+    async def wait_for_prompt(self, **kwargs):
+        """Like blocking_prompt, but for use in coroutines, which can't run a
+        nested main loop."""
+        future = asyncio.get_event_loop().create_future()
+
+        def callback(value):
+            if not future.done():
+                future.set_result(value)
+
+        def cancel():
+            callback(None)
+
+        self.browser.present()
+        self.prompt(callback, cancel=cancel, **kwargs)
+        return await future
+
     def prompt(self, callback, suggestions=None, force_match=False,
                glob=False, prompt='', initial='', cancel=None,
-               case_sensitive=False, beginning=True, private=False):
+               case_sensitive=False, beginning=True, private=False, fuzzy=None):
         self.callback = callback
-        self.suggestions = suggestions or []
+        self.suggestions = CompletionIndex(suggestions or [], case_sensitive=case_sensitive)
+        self.schedule_indexing()
         self.force_match = force_match
         self.glob = glob
         self.lock_suggestions = False
         self.cancel = cancel
         self.case_sensitive = case_sensitive
         self.beginning = beginning
+        if fuzzy is None:
+            fuzzy = getattr(self.browser.roland.config, 'fuzzy_completion', False)
+        self.fuzzy = fuzzy
         self.input.set_visibility(not private)
 
         self.label.set_markup('{}:'.format(prompt))
@@ -921,21 +1174,29 @@ class EntryLine(Gtk.VBox):
         self.get_toplevel().set_focus(self.input)
         self.input.select_region(-1, -1)
 
-        self.remove_completions()
-        self.add_completions()
+        self.update_completions()
         self.browser.set_mode(Mode.Prompt)
 
+    def add_suggestions(self, suggestions):
+        """Add suggestions to the running prompt, e.g. as they arrive from the
+        web process."""
+        self.suggestions.extend(suggestions)
+        self.schedule_indexing()
+
+        if not self.lock_suggestions:
+            self.schedule_completions()
+
     def fire_cancel_callback(self):
         if self.cancel:
             cancel, self.cancel = self.cancel, None
             cancel()
 
     def fire_callback(self):
+        self.flush_completions()
         t = self.input.get_text()
         if self.force_match:
-            labels = [l.get_text() for l in self.get_children() if isinstance(l, Gtk.Label)]
-            if labels and t not in labels:
-                t = labels[0]
+            if self.matches and t not in self.matches:
+                t = self.matches[0]
 
         assert self.callback is not None
 
@@ -943,39 +1204,84 @@ class EntryLine(Gtk.VBox):
         callback(t)
 
     def hide_input(self):
+        self.cancel_completions()
+        if self.index_source is not None:
+            GLib.source_remove(self.index_source)
+            self.index_source = None
         self.hide()
         self.status_line.show()
         self.get_toplevel().set_focus(None)
 
-    def add_completions(self):
+    def query_completions(self):
         t = self.input.get_text()
         if self.glob:
-            entries = fnmatch.filter(self.suggestions, '*{}*'.format(t))
+            return self.suggestions.iter_glob(t, limit=self.completion_limit)
+        elif self.fuzzy:
+            return self.suggestions.iter_fuzzy(t, limit=self.completion_limit)
         else:
-            if self.case_sensitive:
-                f = str.casefold
-            else:
-                f = lambda a: a
+            return self.suggestions.iter_search(t, beginning=self.beginning, limit=self.completion_limit)
+
+    def update_completions(self):
+        self.cancel_completions()
+        self.set_completions(run_steps(self.query_completions()))
+
+    def schedule_completions(self):
+        """Filter completions once typing pauses, in chunks from the main
+        loop. A newer keystroke abandons the pending pass."""
+        self.cancel_completions()
+        self.completion_source = GLib.timeout_add(self.completion_delay, self.on_completion_timeout)
+
+    def cancel_completions(self):
+        if self.completion_source is not None:
+            GLib.source_remove(self.completion_source)
+            self.completion_source = None
+        self.completion_steps = None
+
+    def flush_completions(self):
+        if self.completion_source is not None:
+            self.update_completions()
+
+    def on_completion_timeout(self):
+        self.completion_steps = self.query_completions()
+        self.completion_source = GLib.idle_add(self.on_completion_idle)
+        return False
 
-            if self.beginning:
-                condition = str.startswith
-            else:
-                condition = str.__contains__
-            entries = [e for e in self.suggestions if condition(f(e), f(t))]
+    def schedule_indexing(self):
+        """Build trigram postings for big suggestion lists when there's
+        nothing else to do."""
+        if self.index_source is None and self.suggestions.needs_indexing():
+            self.index_source = GLib.idle_add(self.on_index_idle, priority=GLib.PRIORITY_LOW)
+
+    def on_index_idle(self):
+        deadline = time.monotonic() + self.completion_budget
+        while time.monotonic() < deadline:
+            if not self.suggestions.index_step():
+                self.index_source = None
+                return False
+        return True
 
-        for entry in reversed(entries[:20]):
-            # FIXME: highlight matching portion
-            l = Gtk.Label()
-            l.set_alignment(0.0, 0.5)
-            l.set_text(entry)
-            l.modify_font(self.font)
-            self.pack_end(l, False, False, 0)
-            l.show()
+    def on_completion_idle(self):
+        deadline = time.monotonic() + self.completion_budget
+        try:
+            while time.monotonic() < deadline:
+                next(self.completion_steps)
+        except StopIteration as e:
+            self.completion_source = self.completion_steps = None
+            self.set_completions(e.value)
+            return False
+        return True
 
-    def remove_completions(self):
-        for child in self.get_children():
-            if child != self.input_container:
-                self.remove(child)
+    def set_completions(self, entries):
+        # FIXME: highlight matching portion
+        for i, label in enumerate(self.completion_labels):
+            if i < len(entries):
+                if i >= len(self.matches) or self.matches[i] != entries[i]:
+                    label.set_text(entries[i])
+                if i >= len(self.matches):
+                    label.show()
+            elif i < len(self.matches):
+                label.hide()
+        self.matches = entries
 
 
 class StatusLine(Gtk.HBox):
@@ -1097,6 +1403,7 @@ class BrowserView(BrowserCommands):
         self.webview = None
         self.sub_commands = None
         self.lazy = lazy
+        self.pending_text = []
 
     @classmethod
     def from_webview(cls, browser, roland):
@@ -1279,10 +1586,30 @@ class BrowserView(BrowserCommands):
                 request.authenticate(cred)
         return True
 
+    def append_text(self, text):
+        """Append to the end of a page loaded with load_plain_text, e.g. as
+        more of it streams in."""
+        self.pending_text.append(text)
+
+        if not self.webview.is_loading():
+            self.flush_pending_text()
+
+    def flush_pending_text(self):
+        text, self.pending_text = ''.join(self.pending_text), []
+        script = "document.querySelector('pre').insertAdjacentText('beforeend', {});"
+        self.webview.run_javascript(script.format(json.dumps(text)), None, None, None)
+
     def on_load_status(self, webview, load_status):
         if self.webview != webview:
             return
-        if load_status == WebKit2.LoadEvent.COMMITTED:
+        if load_status == WebKit2.LoadEvent.FINISHED:
+            if self.pending_text:
+                self.flush_pending_text()
+
+            history = self.roland.get_extension('HistoryManager')
+            if history is not None:
+                history.record(webview.get_uri())
+        elif load_status == WebKit2.LoadEvent.COMMITTED:
             is_https, certificate, flags = webview.get_tls_info()
 
             if is_https and certificate is not None:
@@ -1316,6 +1643,9 @@ class BrowserView(BrowserCommands):
         return False
 
     def on_resource_load_started(self, webview, resource, request):
+        if not self.roland.has_subscribers('hsts_header'):
+            return
+
         def finished(resource, *ignored):
             response = resource.get_response()
 
@@ -1327,9 +1657,8 @@ class BrowserView(BrowserCommands):
                 return
             hsts = headers.get_one('Strict-Transport-Security')
 
-            if hsts is not None and self.roland.is_enabled('HSTSExtension'):
-                ext = self.roland.get_extension('HSTSExtension')
-                ext.add_entry(response.get_uri(), hsts)
+            if hsts is not None:
+                self.roland.call_hook('hsts_header', response.get_uri(), hsts)
 
         resource.connect('finished', finished)
 
@@ -1524,15 +1853,12 @@ class BrowserView(BrowserCommands):
 
     def run_command(self, name, *args):
         log.info('Running "{}" command', name)
-        try:
-            command = getattr(self, name)
-        except AttributeError:
-            for command in dir(BrowserCommands):
-                func = getattr(self, command)
-                if getattr(func, '__name__', None) == name:
-                    command = func
-                    break
-            else:
+        if name in self.roland.commands:
+            command = self.roland.commands[name].bind(self)
+        else:
+            try:
+                command = getattr(self, name)
+            except AttributeError:
                 self.roland.notify("No such command '{}'".format(name))
                 return
 
@@ -1657,6 +1983,8 @@ class Roland(RolandConfigBase, Gtk.Application):
         self.connect('command-line', self.on_command_line)
 
         self.previous_sessions = []
+        self.highlight_pool = None
+        self.highlighted_sources = collections.OrderedDict()
         self.load_config()
         self.before_run()
 
@@ -1762,6 +2090,16 @@ class Roland(RolandConfigBase, Gtk.Application):
         if not background:
             window.present()
 
+    def open_text_window(self, text):
+        """Open a window displaying text, returning it so more can be added
+        with append_text."""
+        window = self.browser_view(self)
+        window.start('about:blank')
+        window.webview.load_plain_text(text)
+        self.add_window(window)
+        window.present()
+        return window
+
     def add_window(self, window):
         if isinstance(window, BrowserTab):
             self.window.add(window)
@@ -1798,6 +2136,9 @@ class Roland(RolandConfigBase, Gtk.Application):
 
         self.browser_view = getattr(self.config, 'browser_view', self.browser_view)
 
+        self.commands = command_registry(BrowserCommands)
+        self.available_commands = None
+
         if self.config.enable_disk_cache:
             self.connect('profile-set', self.set_disk_cache)
 
@@ -1818,7 +2159,7 @@ class Roland(RolandConfigBase, Gtk.Application):
         context.set_spell_checking_enabled(getattr(self.config, 'spell_checking_enabled', False))
         context.set_spell_checking_languages(getattr(self.config, 'spell_checking_languages', []))
 
-        self.extensions = sorted([ext(self) for ext in self.config.extensions], key=lambda ext: ext.sort_order)
+        self.set_extensions(self.config.extensions)
 
     def set_disk_cache(self, roland, profile):
         context = WebKit2.WebContext.get_default()
@@ -1892,36 +2233,59 @@ class Roland(RolandConfigBase, Gtk.Application):
         self.emit('new-browser', url, text, html, background, lazy, title, session)
 
     def get_help(self, name):
+        if name in self.commands:
+            return self.commands[name].help
         command = getattr(BrowserCommands, name, None)
-
-        if command is None:
-            # renamed function
-            for func in dir(BrowserCommands):
-                func = getattr(BrowserCommands, func)
-                if getattr(func, '__name__', None) == name:
-                    command = func
-                    break
-        help = getattr(command, '__doc__', None) or 'No help available'
-        return help
+        return getattr(command, '__doc__', None) or 'No help available'
 
     def get_commands(self):
-        def name(f):
-            func = getattr(BrowserCommands, f)
-            return getattr(func, '__name__', f)
-
-        def is_private(name):
-            if name.startswith('__'):
-                return True
-            attr = getattr(BrowserCommands, name)
-            return getattr(attr, 'private', False)
+        """Names of the commands to suggest in the command prompt."""
+        if self.available_commands is None:
+            self.available_commands = [
+                command.name for command in self.commands.values()
+                if not command.private and all(self.is_enabled(ext) for ext in command.extensions)]
+        return self.available_commands
+
+    def register_command(self, name, func, private=False, requires=()):
+        """Add a command, e.g. from an extension's setup. func is called with
+        the browser and the command's arguments."""
+        self.commands[name] = Command(name, None, func, private, requires)
+        self.available_commands = None
+
+    async def highlight_source(self, source):
+        """Syntax highlight page source in a worker process, so big pages
+        don't hold up the UI. Returns None for sources over the
+        view_source_highlight_limit config, or if pygments isn't available.
+        """
+        if len(source) > getattr(self.config, 'view_source_highlight_limit', 1024*1024):
+            return None
 
-        def meets_requirements(f):
-            func = getattr(BrowserCommands, f)
-            extensions = getattr(func, 'extensions', [])
-            return all(self.is_enabled(ext) for ext in extensions)
+        key = hashlib.sha1(source.encode('utf8')).hexdigest()
 
-        return [name(f) for f in dir(BrowserCommands) if not is_private(f) and
-                meets_requirements(f)]
+        try:
+            highlighted = self.highlighted_sources.pop(key)
+        except KeyError:
+            if self.highlight_pool is None:
+                # spawn, forking a GTK application isn't safe.
+                self.highlight_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+
+            loop = asyncio.get_event_loop()
+            highlighted = await loop.run_in_executor(
+                self.highlight_pool, highlight_source, source)
+
+        # keep the most recently viewed few around
+        self.highlighted_sources[key] = highlighted
+        while len(self.highlighted_sources) > 8:
+            self.highlighted_sources.popitem(last=False)
+
+        return highlighted
+
+    def webprocess(self, page_id):
+        return WebProcess(
+            self.profile, page_id,
+            timeout=getattr(self.config, 'webprocess_timeout', 10),
+            max_queued=getattr(self.config, 'webprocess_max_queued', 64))
 
     def most_popular_urls(self):
         if not self.is_enabled('HistoryManager'):
@@ -1936,4 +2300,7 @@ class Roland(RolandConfigBase, Gtk.Application):
             self.notify("Not quitting, {} downloads in progress.".format(len(self.downloads)))
             return
 
+        if self.highlight_pool is not None:
+            self.highlight_pool.shutdown(wait=False)
+
         Gtk.Application.quit(self)
@@ -1,22 +1,29 @@
+import atexit
 import base64
 import datetime
 import hashlib
+import heapq
+import hmac
 import itertools
 import json
+import math
+import mmap
 import os
 import re
 import sqlite3
-from collections import namedtuple
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from urllib import request, parse as urlparse
 
 import logbook
 import msgpack
 from Crypto import Random
 from Crypto.Cipher import AES
-from gi.repository import Gio, WebKit2
+from gi.repository import Gio, GLib, WebKit2
 from werkzeug import parse_dict_header
 
-from .utils import config_path
+from .utils import config_path, get_pretty_size
 
 log = logbook.Logger('roland.extensions')
 
@@ -70,50 +77,198 @@ class NotificationManager(Extension):
         n.show()
 
 
+# Frecency scores are the sum of 2 ** ((visit time - FRECENCY_EPOCH) / half
+# life) over every visit. Decaying every score by the same amount doesn't
+# change their order, so the sum never needs updating as time passes. Scores
+# are kept as their log2 so they don't overflow.
+FRECENCY_EPOCH = 1420070400  # 2015-01-01
+FRECENCY_HALF_LIFE = 30 * 24 * 60 * 60
+
+
+def visit_score(count, timestamp):
+    """log2 frecency score of count visits at timestamp."""
+    return math.log2(count) + (timestamp - FRECENCY_EPOCH) / FRECENCY_HALF_LIFE
+
+
+def add_scores(a, b):
+    """Add two log2 frecency scores."""
+    if a < b:
+        a, b = b, a
+    return a + math.log2(1 + 2 ** (b - a))
+
+
 class HistoryManager(Extension):
+    """Records page visits from the main process.
+
+    Visits are collected in memory and written in one transaction every
+    flush_interval seconds, and at shutdown. URLs are ranked by frecency, a
+    visit count that decays by half every FRECENCY_HALF_LIFE.
+
+    The scores of the most popular URLs are loaded in the background at
+    startup and kept up to date as visits are recorded, so prompts never wait
+    on the database. URLs outside that set only count visits from this
+    session.
+    """
+    # seconds to wait on other processes holding the database lock
+    busy_timeout = 5.0
+    flush_interval = 10
+    # how many URLs most_popular_urls returns
+    popular_limit = 500
+
+    # schema changes, the database's user_version is how many have been run.
+    migrations = [
+        # url as the primary key, last visit times and an index for ranking
+        [
+            'create table history_new '
+            '(url text primary key, view_count integer not null, last_visit real)',
+            'insert into history_new (url, view_count) '
+            'select url, sum(view_count) from history group by url',
+            'drop table history',
+            'alter table history_new rename to history',
+            'create index history_view_count on history (view_count desc)',
+        ],
+        # precomputed frecency scores, treating old visits as happening now
+        [
+            'alter table history add column frecency real not null default 0',
+            "update history set frecency = "
+            "visit_score(max(view_count, 1), "
+            "coalesce(last_visit, cast(strftime('%s', 'now') as real)))",
+            'create index history_frecency on history (frecency desc)',
+        ],
+    ]
+
+    db = None
+
     def setup(self):
-        self.create_history_db()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.flush_source = None
+        # url -> frecency, and the cached ranking of it
+        self.scores = {}
+        self.popular = None
+        self.preloaded = threading.Event()
+        try:
+            self.create_history_db()
+        except Exception:
+            # nothing to preload, most_popular_urls shouldn't wait for it
+            self.preloaded.set()
+            raise
+
+        threading.Thread(target=self.preload, daemon=True).start()
+
+        self.roland.connect('shutdown', self.on_shutdown)
 
     def create_history_db(self):
         conn = self.get_history_db()
 
-        cursor = conn.cursor()
-        cursor.execute('create table if not exists history '
-                       '(url text, view_count integer)')
-        conn.commit()
-        conn.close()
+        with self.lock, conn:
+            conn.execute('begin immediate')
+            conn.execute('create table if not exists history '
+                         '(url text, view_count integer)')
+
+            version, = conn.execute('pragma user_version').fetchone()
+            for version, migration in enumerate(self.migrations[version:], version + 1):
+                log.info("Migrating history database to version {}", version)
+                for statement in migration:
+                    conn.execute(statement)
+                conn.execute('pragma user_version = {:d}'.format(version))
 
     def get_history_db(self):
-        return sqlite3.connect(config_path('history.{}.db', self.roland.profile))
+        """Return the history database connection for this process, opening it
+        on first use.
 
-    def update(self, url):
-        if url == 'about:blank':
-            return False
+        The connection is long-lived and shared between threads under
+        self.lock. sqlite3 keeps the statements it has run prepared, and WAL
+        journaling lets readers in other processes carry on while one writes.
+        """
+        if self.db is None:
+            self.db = sqlite3.connect(
+                config_path('history.{}.db', self.roland.profile),
+                timeout=self.busy_timeout, check_same_thread=False)
+            self.db.execute('pragma journal_mode = wal')
+            self.db.execute('pragma synchronous = normal')
+            self.db.create_function('visit_score', 2, visit_score)
+            self.db.create_function('add_scores', 2, add_scores)
+        return self.db
 
-        conn = self.get_history_db()
-        cursor = conn.cursor()
+    def on_shutdown(self, app):
+        if self.flush_source is not None:
+            GLib.source_remove(self.flush_source)
+            self.flush_source = None
+        self.flush()
+
+    def on_flush_timeout(self):
+        self.flush_source = None
+        self.flush()
+        return False
 
-        cursor.execute('select url from history where url = ?', (url,))
-        rec = cursor.fetchone()
+    def record(self, url):
+        if url in (None, 'about:blank'):
+            return
 
-        if rec is None:
-            cursor.execute('insert into history (url, view_count)'
-                           'values (?, 1)', (url,))
-        else:
-            cursor.execute('update history set view_count = view_count + 1 '
-                           'where url = ?', (url,))
-        conn.commit()
-        conn.close()
+        now = time.time()
+        with self.lock:
+            count, last_visit = self.pending.get(url, (0, None))
+            self.pending[url] = count + 1, now
 
-        return False
+            # until preloading is done, visits are picked up from pending
+            if self.preloaded.is_set():
+                self.add_score(url, visit_score(1, now))
 
-    def most_popular_urls(self):
+        if self.flush_source is None:
+            self.flush_source = GLib.timeout_add_seconds(self.flush_interval, self.on_flush_timeout)
+
+    def flush(self):
         conn = self.get_history_db()
-        cursor = conn.cursor()
-        cursor.execute('select url from history order by view_count desc limit 500')
-        urls = [url for (url,) in cursor.fetchall()]
-        conn.close()
-        return urls
+
+        with self.lock, conn:
+            pending, self.pending = self.pending, {}
+            if not pending:
+                return
+
+            conn.executemany(
+                'insert into history (url, view_count, last_visit, frecency) '
+                'values (?, ?, ?, ?) '
+                'on conflict (url) do update set '
+                'view_count = view_count + excluded.view_count, '
+                'last_visit = excluded.last_visit, '
+                'frecency = add_scores(frecency, excluded.frecency)',
+                [(url, count, last_visit, visit_score(count, last_visit))
+                 for (url, (count, last_visit)) in pending.items()])
+
+    def preload(self):
+        with self.lock:
+            try:
+                cursor = self.get_history_db().execute(
+                    'select url, frecency from history order by frecency desc limit ?',
+                    (self.popular_limit,))
+                self.scores.update(cursor.fetchall())
+            except Exception:
+                log.exception("Failed to load history")
+            finally:
+                for url, (count, last_visit) in self.pending.items():
+                    self.add_score(url, visit_score(count, last_visit))
+                self.preloaded.set()
+
+    def add_score(self, url, score):
+        if url in self.scores:
+            score = add_scores(self.scores[url], score)
+        self.scores[url] = score
+        self.popular = None
+
+    def most_popular_urls(self):
+        # this is called from the UI, don't wait on a slow database
+        if not self.preloaded.is_set():
+            log.info("History is still loading")
+            return []
+
+        with self.lock:
+            if self.popular is None:
+                self.popular = heapq.nlargest(self.popular_limit, self.scores, key=self.scores.get)
+                # forget URLs that have fallen well out of the ranking
+                if len(self.scores) > 2 * self.popular_limit:
+                    self.scores = {url: self.scores[url] for url in self.popular}
+            return list(self.popular)
 
 
 class DownloadManager(Extension):
@@ -294,52 +449,275 @@ class TLSErrorByPassExtension(Extension):
         client.connect_to_host_async(host, 443, None, callback)
 
 
+class HSTSMatcher:
+    """HSTS policies by domain, for checking hosts without a database query.
+
+    Domains with a leading '.' also cover their subdomains.
+    """
+    def __init__(self, entries=()):
+        self.expiries = dict(entries)
+
+    def add(self, domain, expiry):
+        self.expiries[domain] = expiry
+
+    def match(self, host, now):
+        if self.expiries.get(host, now) > now:
+            return True
+
+        labels = host.split('.')
+        for i in range(len(labels)):
+            if self.expiries.get('.' + '.'.join(labels[i:]), now) > now:
+                return True
+        return False
+
+
+HSTS_PRELOAD_URL = 'https://raw.githubusercontent.com/chromium/chromium/main/net/http/transport_security_state_static.json'
+HSTS_PRELOAD_HEADER = b'roland hsts preload 1\n'
+# compiled snapshot shipped with the package, used until roland-update-hsts
+# writes one to the config directory
+HSTS_PRELOAD_PACKAGED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hsts_preload')
+
+
+def hsts_preload_key(domain):
+    """Preload list key for a domain, its labels reversed so entries for a
+    site sort together."""
+    return '.'.join(reversed(domain.split('.'))).encode('utf8')
+
+
+def compile_hsts_preload(raw):
+    """Compile Chromium's HSTS preload JSON into the format read by
+    HSTSPreloadList: a header line, then sorted lines of
+    '<key>\\t<1 if subdomains are included, else 0>'.
+    """
+    # JSON with comments? wild
+    hsts = json.loads(re.sub(r'^ *?//.*$', '', raw, flags=re.MULTILINE))
+
+    entries = {}
+    for entry in hsts['entries']:
+        if entry.get('mode') == 'force-https':
+            key = hsts_preload_key(entry['name'].lower())
+            entries[key] = b'1' if entry.get('include_subdomains') else b'0'
+
+    return HSTS_PRELOAD_HEADER + b''.join(
+        key + b'\t' + flag + b'\n' for key, flag in sorted(entries.items()))
+
+
+def update_hsts_preload(path, source=HSTS_PRELOAD_URL):
+    """Fetch and compile the preload list from a URL or file, replacing path
+    atomically so running processes keep their mapping of the old one.
+    Returns the number of entries."""
+    if os.path.exists(source):
+        with open(source, encoding='utf8') as f:
+            raw = f.read()
+    else:
+        raw = request.urlopen(source).read().decode('utf8')
+
+    compiled = compile_hsts_preload(raw)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(compiled)
+    os.replace(tmp, path)
+
+    return compiled.count(b'\n') - 1
+
+
+class HSTSPreloadList:
+    """Memory-mapped HSTS preload list, as written by compile_hsts_preload.
+
+    Lookups binary search the lines of the file in place, so nothing is
+    parsed at startup and the pages are shared between processes.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.data[:len(HSTS_PRELOAD_HEADER)] != HSTS_PRELOAD_HEADER:
+            raise ValueError('{} is not an HSTS preload list'.format(path))
+        self.start = len(HSTS_PRELOAD_HEADER)
+
+    def find(self, key):
+        """Return the flag of key's entry, or None if it has none."""
+        data = self.data
+        lo, hi = self.start, len(data)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = data.rfind(b'\n', self.start - 1, mid) + 1
+            end = data.find(b'\n', start)
+            entry, flag = data[start:end].split(b'\t')
+
+            if entry == key:
+                return flag
+            elif entry < key:
+                lo = end + 1
+            else:
+                hi = start
+        return None
+
+    def match(self, host):
+        if self.find(hsts_preload_key(host)) is not None:
+            return True
+
+        labels = host.split('.')
+        for i in range(1, len(labels)):
+            if self.find(hsts_preload_key('.'.join(labels[i:]))) == b'1':
+                return True
+        return False
+
+
 class HSTSExtension(Extension):
+    """Upgrades requests to HTTPS for hosts with an HSTS policy.
+
+    Policies are checked against an in-memory HSTSMatcher. When another
+    process has written to the database, rows added since the last load are
+    read into it, checking at most every refresh_interval seconds.
+
+    Preloaded policies come from a memory-mapped HSTSPreloadList. The
+    snapshot packaged with Roland is used unless roland-update-hsts has
+    written a newer one to the config directory, which running processes
+    pick up on their next refresh.
+
+    Observed headers are parsed once per host and header value every
+    reobserve_interval seconds, and written in one transaction every
+    flush_interval seconds.
+
+    The main process purges expired policies from the database every
+    maintenance_interval seconds in a background thread. It vacuums the
+    database when more than vacuum_threshold of it is free pages.
+    """
+    refresh_interval = 5
+    flush_interval = 10
+    reobserve_interval = 60 * 60
+    maintenance_delay = 5 * 60
+    maintenance_interval = 24 * 60 * 60
+    vacuum_threshold = 0.25
+
+    # schema changes, the database's user_version is how many have been run.
+    migrations = [
+        # ids that only ever increase, so rows written since a given point
+        # can be found
+        [
+            'create table hsts_new (id integer primary key autoincrement, '
+            'domain text unique, expiry timestamp)',
+            'insert into hsts_new (domain, expiry) select domain, expiry from hsts',
+            'drop table hsts',
+            'alter table hsts_new rename to hsts',
+        ],
+        # older versions inserted the whole preload list with one expiry,
+        # it's read from the preload list file now
+        [
+            'delete from hsts where expiry in '
+            '(select expiry from hsts group by expiry having count(*) > 1000)',
+        ],
+    ]
+    # migrations to this version and later drop rows covered by the preload
+    # list, so they wait until one can be opened
+    preload_version = 2
+
     def setup(self):
+        self.matcher = HSTSMatcher()
+        self.loaded_mtime = None
+        self.loaded_id = 0
+        self.next_refresh = 0
+        self.preload_mtime = None
+        self.preload = self.open_preload_list()
+        # (host, header) -> when it was last parsed, and domain -> expiry
+        self.seen = {}
+        self.pending = {}
+        self.flush_source = None
         self.create_hsts_db()
+        self.roland.subscribe('hsts_header', self.add_entry)
+        atexit.register(self.flush)
 
-    def create_hsts_db(self):
-        conn = self.get_hsts_db()
+        self.stats = {}
+        if not self.roland.web_process:
+            self.roland.register_command('hsts-stats', self.show_stats)
+            GLib.timeout_add_seconds(self.maintenance_delay, self.on_maintenance_timeout)
 
-        cursor = conn.cursor()
+    def get_preload_mtime(self):
         try:
-            cursor.execute('create table hsts '
-                           '(domain text unique, expiry timestamp)')
-        except Exception:
-            pass  # already exists
-        else:
-            self.create_initial_db()
-        conn.commit()
-        conn.close()
+            return os.stat(config_path('hsts_preload')).st_mtime_ns
+        except FileNotFoundError:
+            return None
 
-    def create_initial_db(self):
-        self.roland.notify("You don't have any HSTS entries. Downloading Chromium's preload list.")
-        raw = request.urlopen('https://raw.githubusercontent.com/scheib/chromium/master/net/http/transport_security_state_static.json').read().decode('utf8')
+    def open_preload_list(self):
+        """Open the preload list from the config directory, falling back to
+        the packaged snapshot."""
+        self.preload_mtime = self.get_preload_mtime()
 
-        # JSON with comments? wild
-        hsts = json.loads(re.sub(r'^ *?//.*$', '', raw, flags=re.MULTILINE))
+        for path in (config_path('hsts_preload'), HSTS_PRELOAD_PACKAGED):
+            try:
+                return HSTSPreloadList(path)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                log.exception("Couldn't load HSTS preload list {}", path)
+        return None
 
-        entries = []
+    def create_hsts_db(self):
+        conn = self.get_hsts_db()
+        try:
+            with conn:
+                conn.execute('begin immediate')
+                conn.execute('create table if not exists hsts '
+                             '(domain text unique, expiry timestamp)')
+
+                version, = conn.execute('pragma user_version').fetchone()
+                for version, migration in enumerate(self.migrations[version:], version + 1):
+                    if version >= self.preload_version and self.preload is None:
+                        log.warning("Keeping legacy HSTS preload rows until there's a preload list")
+                        break
+                    log.info("Migrating HSTS database to version {}", version)
+                    for statement in migration:
+                        conn.execute(statement)
+                    conn.execute('pragma user_version = {:d}'.format(version))
+        finally:
+            conn.close()
 
-        expiry = datetime.datetime.now() + datetime.timedelta(days=365)
-        for entry in hsts['entries']:
-            if entry.get('mode') == 'force-https':
-                domain = entry['name']
-                if entry.get('include_subdomains'):
-                    domain = '.' + domain
+    def get_hsts_db(self):
+        return sqlite3.connect(config_path('hsts.{}.db', self.roland.profile), detect_types=sqlite3.PARSE_DECLTYPES)
 
-                entries.append((domain, expiry))
+    def refresh(self):
+        now = time.monotonic()
+        if now < self.next_refresh:
+            return
+        self.next_refresh = now + self.refresh_interval
 
-        with self.get_hsts_db() as conn:
-            cursor = conn.cursor()
-            cursor.executemany('insert into hsts (domain, expiry) '
-                               'values (?, ?)', entries)
-            conn.commit()
+        if self.get_preload_mtime() != self.preload_mtime:
+            self.preload = self.open_preload_list()
 
-    def get_hsts_db(self):
-        return sqlite3.connect(config_path('hsts.{}.db', self.roland.profile), detect_types=sqlite3.PARSE_DECLTYPES)
+        try:
+            mtime = os.stat(config_path('hsts.{}.db', self.roland.profile)).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.loaded_mtime:
+            return
+
+        # replaced rows get new ids, and deleted rows have expired anyway
+        conn = self.get_hsts_db()
+        try:
+            rows = conn.execute('select id, domain, expiry from hsts where id > ? order by id',
+                                (self.loaded_id,)).fetchall()
+        finally:
+            conn.close()
+        for id, domain, expiry in rows:
+            if domain not in self.pending:
+                self.matcher.add(domain, expiry)
+        if rows:
+            self.loaded_id = rows[-1][0]
+        self.loaded_mtime = mtime
+        log.debug("Loaded {} HSTS entries", len(rows))
 
     def add_entry(self, uri, hsts_header):
+        host = urlparse.urlsplit(uri).hostname
+        now = time.monotonic()
+        seen = self.seen.get((host, hsts_header))
+        if host is None or (seen is not None and now - seen < self.reobserve_interval):
+            return
+        self.seen[host, hsts_header] = now
+
         parsed = parse_dict_header(hsts_header)
         max_age, *rest = parsed['max-age'].split(';', 1)
 
@@ -347,50 +725,106 @@ class HSTSExtension(Extension):
         if rest:
             include_subdomains = 'includesubdomains' in rest[0].lower()
 
-        domain = urlparse.urlparse(uri).netloc
+        domain = host
         if include_subdomains:
             domain = '.' + domain
         max_age = int(max_age)
 
         expiry = datetime.datetime.now() + datetime.timedelta(seconds=max_age)
+        self.matcher.add(domain, expiry)
+        self.pending[domain] = expiry
 
-        with self.get_hsts_db() as conn:
-            cursor = conn.cursor()
-            cursor.execute('insert or replace into hsts (domain, expiry) '
-                           'values (?, ?)', (domain, expiry))
-            conn.commit()
+        if self.flush_source is None:
+            self.flush_source = GLib.timeout_add_seconds(self.flush_interval, self.on_flush_timeout)
 
-    def check_url(self, uri):
-        domain = urlparse.urlparse(uri).netloc
+    def on_flush_timeout(self):
+        self.flush_source = None
+        self.flush()
+        return False
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
 
-        with self.get_hsts_db() as conn:
-            cursor = conn.cursor()
+        now = time.monotonic()
+        self.seen = {
+            key: seen for (key, seen) in self.seen.items()
+            if now - seen < self.reobserve_interval}
 
-            domains = [
-                domain,   # straight domain match, e.g. lastpass.com
-            ]
+        conn = self.get_hsts_db()
+        try:
+            with conn:
+                conn.executemany('insert or replace into hsts (domain, expiry) '
+                                 'values (?, ?)', pending.items())
+        finally:
+            conn.close()
 
-            if '.' in domain:
-                subdomain, base = domain.split('.', 1)
+    def on_maintenance_timeout(self):
+        threading.Thread(target=self.maintain, daemon=True).start()
+        GLib.timeout_add_seconds(self.maintenance_interval, self.on_maintenance_timeout)
+        return False
 
-                domains.extend([
-                    '.' + base,  # subdomain match, e.g. foo.keyerror.com
-                    '.' + domain  # match base domain for a domain supportinb subdomains, e.g. keyerror.com
-                ])
+    def maintain(self):
+        """Delete expired policies, rebuild the index, and vacuum if enough
+        of the database is unused."""
+        started = time.monotonic()
 
-            cursor.execute('select expiry from hsts '
-                           'where domain in ({})'.format(','.join('?' for i in domains)),
-                           domains)
-            expiries = [expiry for (expiry,) in cursor.fetchall()]
-            if expiries:
-                expiry = expiries[0]
+        conn = self.get_hsts_db()
+        try:
+            with conn:
+                purged = conn.execute(
+                    'delete from hsts where expiry < ?', (datetime.datetime.now(),)).rowcount
+                conn.execute('reindex hsts')
+
+            free_pages, = conn.execute('pragma freelist_count').fetchone()
+            pages, = conn.execute('pragma page_count').fetchone()
+            vacuumed = free_pages > pages * self.vacuum_threshold
+            if vacuumed:
+                conn.execute('vacuum')
+
+            entries, = conn.execute('select count(*) from hsts').fetchone()
+            pages, = conn.execute('pragma page_count').fetchone()
+            page_size, = conn.execute('pragma page_size').fetchone()
+        except sqlite3.Error:
+            log.exception("HSTS database maintenance failed")
+            return
+        finally:
+            conn.close()
+
+        self.stats = {
+            'entries': entries,
+            'purged': purged,
+            'vacuumed': vacuumed,
+            'size': pages * page_size,
+            'duration': time.monotonic() - started,
+            'last_run': datetime.datetime.now(),
+        }
+        log.info("HSTS maintenance purged {} expired entries, {} remain", purged, entries)
+
+    def show_stats(self, browser):
+        """Show the size of the HSTS database and its last maintenance run."""
+        if not self.stats:
+            self.roland.notify('HSTS maintenance has not run yet', header='HSTS')
+            return
 
-                if datetime.datetime.now() <= expiry:
-                    log.info("HSTS for {} is True", uri)
-                    return True
+        self.roland.notify(
+            '{entries} entries, {size_text} on disk. Last maintenance at '
+            '{last_run:%Y-%m-%d %H:%M} purged {purged} entries in {duration:.2f}s'
+            '{vacuum_text}.'.format(
+                size_text=get_pretty_size(self.stats['size']),
+                vacuum_text=' and vacuumed' if self.stats['vacuumed'] else '',
+                **self.stats),
+            header='HSTS')
 
-        log.info("HSTS for {} is False", uri)
-        return False
+    def check_url(self, uri):
+        self.refresh()
+        host = urlparse.urlparse(uri).hostname
+        result = host is not None and (
+            self.matcher.match(host, datetime.datetime.now()) or
+            (self.preload is not None and self.preload.match(host)))
+        log.debug("HSTS for {} is {}", uri, result)
+        return result
 
 
 class UserContentManager(Extension):
@@ -487,13 +921,31 @@ class DBusManager(Extension):
 
 
 class PasswordManagerExtension(Extension):
+    """Encrypted form and HTTP auth storage.
+
+    Each record's domain is also stored as an HMAC keyed from the master key.
+    That lets get_for_domain select and decrypt only matching records without
+    storing domains in the clear. Records saved before the column existed are
+    indexed on the next unlock.
+
+    Decrypted records for the cache_size most recently used domains are kept
+    in memory. They are dropped after idle_timeout seconds without a lookup,
+    and when the database is locked.
+    """
     FormFill = namedtuple('FormFill', 'id last_used description domain form_data')
     BS = AES.block_size
 
+    cache_size = 32
+    idle_timeout = 5 * 60
+
     key = None
 
     def setup(self):
+        # domain hash -> decrypted records, least recently used first
+        self.cache = OrderedDict()
+        self.idle_source = None
         self.create_password_db()
+        self.roland.register_command('lock-passwords', lambda browser: self.lock())
 
     def create_password_db(self):
         conn = self.get_password_db()
@@ -502,9 +954,14 @@ class PasswordManagerExtension(Extension):
         try:
             cursor.execute('create table managed '
                            '(id integer primary key, last_used timestamp, '
-                           ' description text, domain text, data text)')
+                           ' description text, domain text, data text, domain_hash text)')
         except Exception:
             pass  # already exists
+
+        columns = [column[1] for column in cursor.execute('pragma table_info(managed)')]
+        if 'domain_hash' not in columns:
+            cursor.execute('alter table managed add column domain_hash text')
+        cursor.execute('create index if not exists managed_domain_hash on managed (domain_hash)')
         conn.commit()
         conn.close()
 
@@ -578,6 +1035,7 @@ class PasswordManagerExtension(Extension):
                 self.roland.notify('Incorrect password')
             else:
                 self.key = hashlib.sha256(password.encode('utf8')).digest()
+                self.index_domains()
                 return
         raise ValueError('Could not unlock database')
 
@@ -589,17 +1047,73 @@ class PasswordManagerExtension(Extension):
         finally:
             self.key = None
 
+    def domain_hash(self, domain):
+        assert isinstance(domain, bytes)
+        index_key = hmac.new(self.key, b'roland domain index', hashlib.sha256).digest()
+        return hmac.new(index_key, domain, hashlib.sha256).hexdigest()
+
+    def index_domains(self):
+        """Set domain_hash on records saved before it existed."""
+        with self.get_password_db() as db:
+            curs = db.cursor()
+            curs.execute('select id, domain from managed where domain_hash is null')
+            records = curs.fetchall()
+            if records:
+                log.info("Indexing {} saved forms", len(records))
+                curs.executemany(
+                    'update managed set domain_hash = ? where id = ?',
+                    [(self.domain_hash(self.decrypt(encrypted_domain)), id)
+                     for (id, encrypted_domain) in records])
+                db.commit()
+
+    def lock(self):
+        """Forget the master key and any decrypted records."""
+        self.key = None
+        self.wipe_cache()
+
+    def wipe_cache(self):
+        self.cache.clear()
+        if self.idle_source is not None:
+            GLib.source_remove(self.idle_source)
+            self.idle_source = None
+
+    def on_idle_timeout(self):
+        self.idle_source = None
+        self.wipe_cache()
+        return False
+
     def get_for_domain(self, domain):
         assert isinstance(domain, bytes)
+        # the hash depends on the key, so records decrypted under another key
+        # are never returned
+        domain_hash = self.domain_hash(domain)
+
+        if self.idle_source is not None:
+            GLib.source_remove(self.idle_source)
+        self.idle_source = GLib.timeout_add_seconds(self.idle_timeout, self.on_idle_timeout)
+
+        if domain_hash in self.cache:
+            self.cache.move_to_end(domain_hash)
+            return list(self.cache[domain_hash])
+
         with self.get_password_db() as db:
             curs = db.cursor()
-            curs.execute('select id, last_used, description, domain, data from managed order by last_used desc')
+            # unindexed records are only left before the first unlock, e.g.
+            # when test_password checks a password
+            curs.execute('select id, last_used, description, domain, data from managed '
+                         'where domain_hash = ? or domain_hash is null '
+                         'order by last_used desc', (domain_hash,))
             records = curs.fetchall()
-        return [
-            self.FormFill(id, last_used, self.decrypt(encrypted_description), self.decrypt(encrypted_domain), msgpack.loads(self.decrypt(data)))
+        choices = [
+            self.FormFill(id, last_used, self.decrypt(encrypted_description), self.decrypt(encrypted_domain), msgpack.loads(self.decrypt(data), raw=True))
             for (id, last_used, encrypted_description, encrypted_domain, data) in records if self.decrypt(encrypted_domain) == domain
         ]
 
+        self.cache[domain_hash] = choices
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return list(choices)
+
     def save_form(self, domain, form, description=None):
         if description is None:
             description = 'Form for {}'.format(domain)
@@ -607,15 +1121,17 @@ class PasswordManagerExtension(Extension):
         encrypted_description = self.encrypt(description.encode('utf8'))
         encrypted_domain = self.encrypt(domain.encode('utf8'))
         encrypted_form = self.encrypt(msgpack.dumps(form))
+        domain_hash = self.domain_hash(domain.encode('utf8'))
 
-        record = (datetime.datetime.now(), encrypted_description, encrypted_domain, encrypted_form)
+        record = (datetime.datetime.now(), encrypted_description, encrypted_domain, encrypted_form, domain_hash)
 
         with self.get_password_db() as db:
             cursor = db.cursor()
 
-            cursor.execute('insert into managed (last_used, description, domain, data) '
-                           'values (?, ?, ?, ?)', record)
+            cursor.execute('insert into managed (last_used, description, domain, data, domain_hash) '
+                           'values (?, ?, ?, ?, ?)', record)
             db.commit()
+        self.cache.pop(domain_hash, None)
 
     def get_password_db(self):
         return sqlite3.connect(config_path('passwords.{}.db', self.roland.profile), detect_types=sqlite3.PARSE_DECLTYPES)
@@ -625,3 +1141,8 @@ class PasswordManagerExtension(Extension):
             cursor = db.cursor()
 
             cursor.execute('update managed set last_used = ? where id = ?', (datetime.datetime.now(), record_id))
+
+        # the record's domain moves it to the front of its list
+        for domain_hash, choices in list(self.cache.items()):
+            if any(choice.id == record_id for choice in choices):
+                del self.cache[domain_hash]
@@ -1,4 +1,17 @@
+import bisect
+import collections
+import fnmatch
+import heapq
 import os
+import re
+
+
+# Responses from the web process are msgpack frames of
+# [request_id, status, payload]. Streamed responses send any number of chunk
+# frames before the final one.
+RESPONSE_OK = 0
+RESPONSE_ERROR = 1
+RESPONSE_CHUNK = 2
 
 
 def get_pretty_size(bytecount):
@@ -61,6 +74,219 @@ def get_keyname(event):
     return '-'.join(fields)
 
 
+def highlight_source(source):
+    """Syntax highlight HTML source as a full HTML page, or return None if
+    pygments isn't available.
+
+    This is run in a worker process, keep it free of GTK.
+    """
+    try:
+        import pygments
+        import pygments.lexers
+        import pygments.formatters
+    except ImportError:
+        return None
+
+    lexer = pygments.lexers.HtmlLexer()
+    formatter = pygments.formatters.HtmlFormatter(full=True, linenos='table')
+    return pygments.highlight(source, lexer, formatter)
+
+
+def is_subsequence(text, candidate):
+    it = iter(candidate)
+    return all(c in it for c in text)
+
+
+def fuzzy_score(text, candidate):
+    """Score candidate for containing the characters of text in order, or
+    return None if it doesn't.
+
+    Characters matched right after the previous match or at the start of a
+    word score more, and matches spread over a wide span score less.
+    """
+    score = 0
+    first = previous = None
+    for c in text:
+        found = candidate.find(c, 0 if previous is None else previous + 1)
+        if found == -1:
+            return None
+        if first is None:
+            first = found
+        if previous is not None and found == previous + 1:
+            score += 8
+        elif found == 0 or not candidate[found - 1].isalnum():
+            score += 6
+        else:
+            score += 1
+        previous = found
+    if first is None:
+        return 0
+    return score - (previous - first + 1 - len(text)) * 0.5 - first * 0.1
+
+
+def run_steps(steps):
+    """Run a chunked query from CompletionIndex to the end, returning its
+    result."""
+    while True:
+        try:
+            next(steps)
+        except StopIteration as e:
+            return e.value
+
+
+class CompletionIndex:
+    """Index over a prompt's suggestions for prefix, substring, glob and fuzzy
+    queries.
+
+    Results keep the order of the suggestions, apart from fuzzy results which
+    are best first. When the typed text extends the previous query, only the
+    previous matches are searched again.
+
+    The iter_* methods are generators that yield between chunks of
+    chunk_size candidates and return the matches, so a slow query can be
+    spread across main loop iterations or abandoned part way.
+
+    Scanning every suggestion is quick below trigram_threshold. Above it,
+    substring queries use trigram postings for the suggestions indexed so
+    far by index_step, and scan the rest.
+    """
+    chunk_size = 2000
+    trigram_threshold = 20000
+
+    def __init__(self, suggestions=(), case_sensitive=False):
+        self.case_sensitive = case_sensitive
+        self.suggestions = []
+        self.keys = []
+        # (key, position) sorted by key, for prefix queries, sorted on demand
+        self.sorted_keys = []
+        # trigram -> set of positions, for substring queries, covering the
+        # first `indexed` suggestions
+        self.trigrams = collections.defaultdict(set)
+        self.indexed = 0
+        self.last_query = None
+        self.last_matches = None
+        self.extend(suggestions)
+
+    def fold(self, text):
+        return text if self.case_sensitive else text.casefold()
+
+    def extend(self, suggestions):
+        suggestions = list(suggestions)
+        self.suggestions.extend(suggestions)
+        self.keys.extend(self.fold(suggestion) for suggestion in suggestions)
+        self.last_query = self.last_matches = None
+
+    def needs_indexing(self):
+        return len(self.keys) >= self.trigram_threshold and self.indexed < len(self.keys)
+
+    def index_step(self, count=100):
+        """Add trigram postings for the next count suggestions. Returns
+        whether there are more to index."""
+        if not self.needs_indexing():
+            return False
+
+        end = min(self.indexed + count, len(self.keys))
+        for position in range(self.indexed, end):
+            key = self.keys[position]
+            for i in range(len(key) - 2):
+                self.trigrams[key[i:i + 3]].add(position)
+        self.indexed = end
+        return self.needs_indexing()
+
+    def chunks(self, candidates):
+        for start in range(0, len(candidates), self.chunk_size):
+            yield candidates[start:start + self.chunk_size]
+
+    def prefix_matches(self, key):
+        if not key:
+            return range(len(self.keys))
+        if len(self.sorted_keys) != len(self.keys):
+            self.sorted_keys = sorted(zip(self.keys, range(len(self.keys))))
+        lo = bisect.bisect_left(self.sorted_keys, (key,))
+        hi = bisect.bisect_left(self.sorted_keys, (key[:-1] + chr(ord(key[-1]) + 1),))
+        return sorted(position for (_, position) in self.sorted_keys[lo:hi])
+
+    def substring_candidates(self, key):
+        if len(key) < 3 or not self.indexed:
+            return range(len(self.keys))
+        postings = sorted(
+            (self.trigrams.get(key[i:i + 3], ()) for i in range(len(key) - 2)), key=len)
+        indexed = sorted(set(postings[0]).intersection(*postings[1:]))
+        return indexed + list(range(self.indexed, len(self.keys)))
+
+    def iter_search(self, text, beginning=False, limit=None):
+        key = self.fold(text)
+        condition = str.startswith if beginning else str.__contains__
+
+        if self.last_query is not None and self.last_query[0] == beginning and \
+                condition(key, self.last_query[1]):
+            candidates = self.last_matches
+        elif beginning:
+            candidates = self.prefix_matches(key)
+        else:
+            candidates = self.substring_candidates(key)
+
+        matches = []
+        for chunk in self.chunks(candidates):
+            matches.extend(i for i in chunk if condition(self.keys[i], key))
+            yield
+        self.last_query, self.last_matches = (beginning, key), matches
+        return [self.suggestions[i] for i in matches[:limit]]
+
+    def search(self, text, beginning=False, limit=None):
+        """Suggestions starting with text, or containing it if not beginning."""
+        return run_steps(self.iter_search(text, beginning, limit))
+
+    def iter_fuzzy(self, text, limit=20):
+        key = self.fold(text)
+        if not key:
+            self.last_query = self.last_matches = None
+            return self.suggestions[:limit]
+
+        if self.last_query is not None and self.last_query[0] == 'fuzzy' and \
+                is_subsequence(self.last_query[1], key):
+            candidates = self.last_matches
+        else:
+            candidates = range(len(self.keys))
+
+        scored = []
+        for chunk in self.chunks(candidates):
+            for i in chunk:
+                score = fuzzy_score(key, self.keys[i])
+                if score is not None:
+                    # ties go to shorter suggestions, then earlier ones
+                    scored.append((score, -len(self.keys[i]), -i))
+            yield
+        self.last_query = ('fuzzy', key)
+        self.last_matches = sorted(-i for (_, _, i) in scored)
+        return [self.suggestions[-i] for (_, _, i) in heapq.nlargest(limit, scored)]
+
+    def fuzzy(self, text, limit=20):
+        """The best scoring limit suggestions containing the characters of
+        text in order, best first."""
+        return run_steps(self.iter_fuzzy(text, limit))
+
+    def iter_glob(self, pattern, limit=None):
+        # the longest run of plain text has to appear in every match
+        literals = re.split(r'\[!?\]?[^\]]*\]|[*?]', pattern)
+        longest = self.fold(max(literals, key=len, default=''))
+        matcher = re.compile(fnmatch.translate('*{}*'.format(pattern))).match
+
+        matches = []
+        for chunk in self.chunks(self.substring_candidates(longest)):
+            matches.extend(
+                self.suggestions[i] for i in chunk
+                if longest in self.keys[i] and matcher(self.suggestions[i]))
+            if limit is not None and len(matches) >= limit:
+                break
+            yield
+        return matches[:limit]
+
+    def glob(self, pattern, limit=None):
+        """Suggestions matching the glob pattern anywhere."""
+        return run_steps(self.iter_glob(pattern, limit))
+
+
 def init_logging():
     import logbook
     import logbook.more
@@ -88,12 +314,24 @@ def default_config():
 
 
 class RolandConfigBase:
+    # True in web processes, where extensions shouldn't run main process work
+    web_process = False
+
     def load_config(self):
         self.config = load_config()
-        self.extensions = sorted([ext(self) for ext in self.config.extensions], key=lambda ext: ext.sort_order)
+        self.set_extensions(self.config.extensions)
 
         self.make_config_directories()
 
+    def set_extensions(self, extension_types):
+        """Create the configured extensions, indexed by class name for
+        get_extension."""
+        self.subscribers = collections.defaultdict(list)
+        self.extensions = sorted([ext(self) for ext in extension_types], key=lambda ext: ext.sort_order)
+        self.extensions_by_name = {}
+        for ext in self.extensions:
+            self.extensions_by_name.setdefault(ext.__class__.__name__, ext)
+
     def make_config_directories(self):
         for p in cache_path, config_path, runtime_path:
             p = p('')
@@ -109,9 +347,19 @@ class RolandConfigBase:
         if not isinstance(extensiontype, str):
             extensiontype = extensiontype.__name__
 
-        for ext in self.extensions:
-            if ext.__class__.__name__ == extensiontype:
-                return ext
+        return self.extensions_by_name.get(extensiontype)
+
+    def subscribe(self, hook, callback):
+        """Have callback called with the arguments of every call_hook(hook).
+        Extensions subscribe in setup."""
+        self.subscribers[hook].append(callback)
+
+    def has_subscribers(self, hook):
+        return hook in self.subscribers
+
+    def call_hook(self, hook, *args):
+        for callback in self.subscribers.get(hook, ()):
+            callback(*args)
 
     def notify(self, message, critical=False, header=''):
         ext = self.get_extension('NotificationManager')
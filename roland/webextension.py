@@ -1,9 +1,13 @@
 import asyncio
-import functools
+import atexit
+import inspect
 import io
 import os
+import re
+import socket
 import threading
-from collections import namedtuple
+import time
+from collections import deque, namedtuple
 
 import gbulb
 import logbook
@@ -11,28 +15,87 @@ import logbook
 from gi.repository import WebKit2WebExtension
 
 
-from roland.utils import init_logging, runtime_path, load_config, RolandConfigBase
+from roland.utils import (
+    init_logging, runtime_path, load_config, RolandConfigBase,
+    RESPONSE_OK, RESPONSE_ERROR, RESPONSE_CHUNK)
 
 log = logbook.Logger(__name__)
 
-Request = namedtuple('Request', 'id command params')
-Highlight = namedtuple('Highlight', 'nodes node_lists')
+Request = namedtuple('Request', 'id page_id command params')
+
+
+class Highlight:
+    """Hints for one selector on a page.
+
+    Holds the hinted nodes by number and the notes and overlay markup sent
+    for them. The nodes still waiting on highlight_rest are kept as skipped
+    (node, left, top) hints that have been measured, and unmeasured
+    [node_list, start, stop] ranges.
+    """
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.nodes = {}
+        self.node_lists = []
+        self.notes = {}
+        self.overlays = []
+        self.skipped = []
+        self.unmeasured = deque()
+        # the document and frame documents the nodes were found in
+        self.documents = []
+        # whether the overlay is on the page, highlight_rest stops once it's
+        # removed
+        self.shown = False
+
+    def has_deferred(self):
+        return bool(self.skipped or self.unmeasured)
 
 
 class RolandWebExtension(RolandConfigBase):
-    def __init__(self, profile):
+    web_process = True
+
+    def __init__(self, profile, extension):
         gbulb.install(gtk=False)
 
         self.profile = profile
+        self.extension = extension
         self.loop = asyncio.get_event_loop()
         self.load_config()
-        self.pages = {}
         self.highlight_matches = {}
+        self.hint_cache = {}
+        self.watched_documents = {}
+        self.updating_overlay = False
+        self.create_server_socket()
+
+    def create_server_socket(self):
+        """Listen on one socket for every page in this web process.
+
+        Each page gets a symlink to it at webprocess.<profile>.<page_id>, and
+        requests carry the page id to route them. The socket listens from the
+        start, so pages created before the event loop is running don't race
+        it.
+        """
+        self.server_path = runtime_path('webprocess.{}.pid{}'.format(self.profile, os.getpid()))
+
+        try:
+            os.unlink(self.server_path)
+        except FileNotFoundError:
+            pass
+
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(self.server_path)
+        self.server_socket.listen(128)
+        atexit.register(self.remove_server_socket)
+
+    def remove_server_socket(self):
+        try:
+            os.unlink(self.server_path)
+        except FileNotFoundError:
+            pass
 
     def run(self):
         def ignore(ext):
             return ext.__class__.__name__ not in [
-                'HistoryManager',
                 'HSTSExtension',
                 'NotificationManager',
                 'ClipboardManager',
@@ -48,6 +111,10 @@ class RolandWebExtension(RolandConfigBase):
                 log.exception("Failure setting up {}: {}".format(ext.name, e))
                 self.notify("Failure setting up {}: {}".format(ext.name, e), critical=True)
 
+        self.loop.run_until_complete(
+            asyncio.start_unix_server(self.client_connected, sock=self.server_socket))
+        log.info("Started web process server at {}", self.server_path)
+
         self.loop.run_forever()
 
     def do_yank(self, page, yank_id):
@@ -55,7 +122,7 @@ class RolandWebExtension(RolandConfigBase):
 
         page_id = page.get_id()
 
-        node = self.highlight_matches.pop(page_id).nodes[int(yank_id.decode('utf8'))]
+        node = self.highlight_matches[page_id].nodes[int(yank_id.decode('utf8'))]
         url = node.get_href()
 
         if url is not None:
@@ -66,7 +133,7 @@ class RolandWebExtension(RolandConfigBase):
 
         page_id = page.get_id()
 
-        node = self.highlight_matches.pop(page_id).nodes[int(click_id.decode('utf8'))]
+        node = self.highlight_matches[page_id].nodes[int(click_id.decode('utf8'))]
         if new_window:
             url = node.get_href()
             from roland.api import dbus_execute
@@ -85,32 +152,115 @@ class RolandWebExtension(RolandConfigBase):
             if isinstance(node, insert_mode_types):
                 dbus_execute('insert_mode', page_id)
 
-    def do_highlight(self, page, selector):
-        selector = selector.decode('utf8')
-        def is_visible(elem):
-            return int(elem.get_offset_height()) != 0 or int(elem.get_offset_width()) != 0
+    def is_visible(self, elem):
+        return int(elem.get_offset_height()) != 0 or int(elem.get_offset_width()) != 0
+
+    def get_offset(self, elem, offsets):
+        """Position of elem on the screen.
 
-        def get_offset(elem):
+        offsets memoises positions for one highlight pass, so elements sharing
+        offset parents only walk the chain above them once.
+        """
+        try:
+            return offsets[elem]
+        except KeyError:
+            pass
+
+        parent = elem.get_offset_parent()
+        if parent is None:
             x, y = 0, 0
+        else:
+            x, y = self.get_offset(parent, offsets)
 
-            i = 0
-            while elem is not None:
-                i += 1
-                x += elem.get_offset_left() - elem.get_scroll_left()
-                y += elem.get_offset_top() - elem.get_scroll_top()
-                elem = elem.get_offset_parent()
-            return x, y
+        x += elem.get_offset_left() - elem.get_scroll_left()
+        y += elem.get_offset_top() - elem.get_scroll_top()
+        offsets[elem] = x, y
+        return x, y
 
-        i = -1
-        def add_node(node):
-            nonlocal i
+    def get_hint_text(self, node):
+        if isinstance(node, WebKit2WebExtension.DOMHTMLAnchorElement):
+            text = '{} ({})'.format(node.get_text(), node.get_href())
+        elif isinstance(node, WebKit2WebExtension.DOMHTMLInputElement):
+            input_type = node.get_input_type()
 
-            if not is_visible(node):
-                return
+            if input_type in ('submit', 'button'):
+                text = node.get_value()
+            else:
+                text = node.get_name()
+        elif isinstance(node, (WebKit2WebExtension.DOMHTMLSelectElement, WebKit2WebExtension.DOMHTMLFormElement)):
+            text = node.get_name()
+        elif isinstance(node, WebKit2WebExtension.DOMHTMLButtonElement):
+            text = node.get_value()
+        elif isinstance(node, WebKit2WebExtension.DOMHTMLTextAreaElement):
+            text = node.get_name()
+        else:
+            text = node.get_inner_text()
+
+        return re.sub(r'\s\s+', ' ', text or '<unknown>').strip()
 
-            i += 1
+    def hint_documents(self, dom):
+        """Return the document and the documents of each of its frames."""
+        documents = [dom]
+
+        frames = dom.query_selector_all('frame, iframe')
+        for frame in (frames.item(i) for i in range(frames.get_length())):
+            document = frame.get_content_document()
+            if document is not None:
+                documents.append(document)
+        return documents
+
+    def query_hint_lists(self, dom, selector, highlight):
+        """Return the NodeLists matching selector, in the document and then
+        in each of its frames."""
+        highlight.documents = self.hint_documents(dom)
+        highlight.node_lists = [
+            document.query_selector_all(selector) for document in highlight.documents]
+        return highlight.node_lists
+
+    def find_first_below(self, nodes, top, offsets):
+        """Index of the first visible node in nodes at or below top.
+
+        Binary searches on the assumption that document order follows
+        vertical position, which holds well enough for long pages of posts
+        or messages. Invisible nodes have no position and are stepped over.
+        """
+        lo, hi = 0, nodes.get_length()
+
+        while lo < hi:
+            mid = probe = (lo + hi) // 2
+            while probe < hi and not self.is_visible(nodes.item(probe)):
+                probe += 1
+
+            if probe == hi:
+                hi = mid
+            elif self.get_offset(nodes.item(probe), offsets)[1] < top:
+                lo = probe + 1
+            else:
+                hi = mid
+        return lo
+
+    def add_overlay(self, dom, overlay_html):
+        overlay = dom.create_element('div')
+        overlay.set_inner_html(overlay_html)
+
+        self.updating_overlay = True
+        try:
+            html = dom.query_selector('html')
+            html.append_child(overlay)
+            overlay.set_attribute_ns(None, 'class', 'roland_overlay')
+        finally:
+            self.updating_overlay = False
+
+    def add_hints(self, dom, highlight, hints):
+        """Number and overlay the given (node, left, top) hints, returning
+        notes of 'number: description' to number."""
+        notes = {}
+        overlay_html = io.StringIO()
+
+        for node, left, top in hints:
+            i = len(highlight.nodes)
             highlight.nodes[i] = node
-            left, top = get_offset(node)
+
             span = ("<span style=\""
                     "left: " + str(left) + "px;"
                     "top: " + str(top) + "px;"
@@ -127,77 +277,213 @@ class RolandWebExtension(RolandConfigBase):
 
             overlay_html.write(span)
 
-            if isinstance(node, WebKit2WebExtension.DOMHTMLAnchorElement):
-                text = '{} ({})'.format(node.get_text(), node.get_href())
-            elif isinstance(node, WebKit2WebExtension.DOMHTMLInputElement):
-                input_type = node.get_input_type()
+            key = '{}: {}'.format(i, self.get_hint_text(node))
+            notes[key] = str(i)
 
-                if input_type in ('submit', 'button'):
-                    text = node.get_value()
-                else:
-                    text = node.get_name()
-            elif isinstance(node, (WebKit2WebExtension.DOMHTMLSelectElement, WebKit2WebExtension.DOMHTMLFormElement)):
-                text = node.get_name()
-            elif isinstance(node, WebKit2WebExtension.DOMHTMLButtonElement):
-                text = node.get_value()
-            elif isinstance(node, WebKit2WebExtension.DOMHTMLTextAreaElement):
-                text = node.get_name()
-            else:
-                text = node.get_inner_text()
+        if notes:
+            overlay_html = overlay_html.getvalue()
+            self.add_overlay(dom, overlay_html)
 
-            import re
-            key = '{}: {}'.format(i, re.sub('\s\s+', ' ', text or '<unknown>').strip())
+            highlight.notes.update(notes)
+            highlight.overlays.append(overlay_html)
 
-            notes[key] = str(i)
+        return notes
+
+    def get_cached_highlight(self, page_id, dom, selector):
+        highlight = self.hint_cache.get(page_id, {}).get(selector)
+        if highlight is None:
+            return None
+
+        # changes are watched for in the documents that were hinted, a frame
+        # that has navigated since has a new one.
+        documents = self.hint_documents(dom)
+        if len(documents) != len(highlight.documents) or any(
+                a is not b for a, b in zip(documents, highlight.documents)):
+            self.hint_cache.pop(page_id, None)
+            return None
+        return highlight
+
+    def do_highlight(self, page, selector, viewport=False):
+        """Overlay numbered hints on the elements matching selector.
+
+        With viewport set, only elements on or near the screen are hinted,
+        and only for as long as the hint_time_budget config allows. The
+        on-screen elements are found by binary search, so this takes about
+        the same time however long the page is. The rest are streamed by a
+        following highlight_rest request, so the prompt can show without
+        waiting on the whole page.
+
+        Hints are cached per page until the document or one of its frames
+        changes, scrolls or navigates, so highlighting the same selector
+        again just puts the overlay back.
+        """
+        selector = selector.decode('utf8')
+        page_id = page.get_id()
+        dom = page.get_dom_document()
 
-        def add_nodes(dom, selector):
-            nodes = dom.query_selector_all(selector)
-            highlight.node_lists.append(nodes)
-            for node in (nodes.item(i) for i in range(nodes.get_length())):
-                add_node(node)
+        highlight = self.get_cached_highlight(page_id, dom, selector)
+        if highlight is not None:
+            self.highlight_matches[page_id] = highlight
+            self.add_overlay(dom, ''.join(highlight.overlays))
+            highlight.shown = True
 
-        notes = {}
-        overlay_html = io.StringIO()
-        highlight = Highlight({}, [])
+            if not viewport:
+                for notes in self.do_highlight_rest(page):
+                    pass
+            return dict(highlight.notes)
 
+        highlight = Highlight(selector)
+        node_lists = self.query_hint_lists(dom, selector, highlight)
+        offsets = {}
 
-        dom = page.get_dom_document()
+        if viewport:
+            hints = self.find_viewport_hints(dom, node_lists, highlight, offsets)
+        else:
+            hints = [
+                (node,) + self.get_offset(node, offsets)
+                for nodes in node_lists
+                for node in (nodes.item(i) for i in range(nodes.get_length()))
+                if self.is_visible(node)
+            ]
 
-        add_nodes(dom, selector)
+        self.highlight_matches[page_id] = highlight
+        highlight.shown = True
+
+        # only pay for the mutation listeners on documents that get hinted.
+        self.watch_documents(page_id, highlight.documents)
+        self.hint_cache.setdefault(page_id, {})[selector] = highlight
+
+        return self.add_hints(dom, highlight, hints)
+
+    def find_viewport_hints(self, dom, node_lists, highlight, offsets):
+        """Return (node, left, top) hints for the nodes on or near the
+        screen, leaving the rest of each list on highlight to hint later.
+
+        Each list is searched for the first node near the top of the screen,
+        then walked down past the bottom of it and back up past the top,
+        until hint_time_budget runs out.
+        """
+        window = dom.get_default_view()
+        width, height = window.get_inner_width(), window.get_inner_height()
+        margin = height // 2
+        deadline = time.monotonic() + getattr(self.config, 'hint_time_budget', 0.05)
+
+        def measure(nodes, i):
+            """Hint node i if it's on screen and skip it if not, returning
+            whether it's above, on or below the screen as -1, 0 or 1, or None
+            if it isn't visible."""
+            node = nodes.item(i)
+            if not self.is_visible(node):
+                return None
+
+            left, top = self.get_offset(node, offsets)
+            if top < -margin:
+                position = -1
+            elif top > height + margin:
+                position = 1
+            else:
+                position = 0
 
-        frames = dom.query_selector_all('frame, iframe')
+            if position == 0 and -margin <= left <= width + margin:
+                hints.append((node, left, top))
+            else:
+                highlight.skipped.append((node, left, top))
+            return position
+
+        hints = []
+        for nodes in node_lists:
+            count = nodes.get_length()
+            if time.monotonic() > deadline:
+                highlight.unmeasured.append([nodes, 0, count])
+                continue
 
-        for frame in (frames.item(i) for i in range(frames.get_length())):
-            dom = frame.get_content_document()
-            add_nodes(dom, selector)
+            first = self.find_first_below(nodes, -margin, offsets)
 
+            end = first
+            while end < count and time.monotonic() <= deadline:
+                end += 1
+                if measure(nodes, end - 1) == 1:
+                    break
+
+            start = first
+            while start > 0 and time.monotonic() <= deadline:
+                start -= 1
+                if measure(nodes, start) == -1:
+                    break
+
+            highlight.unmeasured.append([nodes, end, count])
+            highlight.unmeasured.append([nodes, 0, start])
+
+        return hints
+
+    def do_highlight_rest(self, page):
+        """Stream the notes for the nodes left over by a viewport highlight,
+        spending at most hint_time_budget on each batch.
+
+        Stops early when the overlay is removed or the page is highlighted
+        again, and the remaining nodes stay on the highlight for next time.
+        """
+        page_id = page.get_id()
         dom = page.get_dom_document()
+        budget = getattr(self.config, 'hint_time_budget', 0.05)
 
-        overlay = dom.create_element('div')
-        overlay.set_inner_html(overlay_html.getvalue())
+        highlight = self.highlight_matches.get(page_id)
+        if highlight is None:
+            return
 
-        html = dom.query_selector('html')
-        html.append_child(overlay)
-        overlay.set_attribute_ns(None, 'class', 'roland_overlay')
+        while highlight.has_deferred():
+            if not highlight.shown or self.highlight_matches.get(page_id) is not highlight:
+                return
 
-        self.highlight_matches[page.get_id()] = highlight
+            offsets = {}
+            deadline = time.monotonic() + budget
+            hints, highlight.skipped = highlight.skipped, []
 
-        return notes
+            unmeasured = highlight.unmeasured
+            while unmeasured and time.monotonic() <= deadline:
+                nodes, start, stop = item = unmeasured[0]
+                if start >= stop:
+                    unmeasured.popleft()
+                    continue
+
+                node = nodes.item(start)
+                item[1] += 1
+                if self.is_visible(node):
+                    hints.append((node,) + self.get_offset(node, offsets))
+
+            notes = self.add_hints(dom, highlight, hints)
+            if notes:
+                yield notes
 
     def do_remove_overlay(self, page):
+        highlight = self.highlight_matches.get(page.get_id())
+        if highlight is not None:
+            highlight.shown = False
+
         dom = page.get_dom_document()
         html = dom.query_selector('html')
 
         overlays = dom.query_selector_all('.roland_overlay')
 
-        for overlay in (overlays.item(i) for i in range(overlays.get_length())):
-            html.remove_child(overlay)
+        self.updating_overlay = True
+        try:
+            for overlay in (overlays.item(i) for i in range(overlays.get_length())):
+                html.remove_child(overlay)
+        finally:
+            self.updating_overlay = False
 
-    def do_get_source(self, page):
+    def do_get_source(self, page, chunk_size=None):
         dom = page.get_dom_document()
         html = dom.query_selector('html')
         text = html.get_outer_html()
-        return {'html': text}
+
+        if chunk_size is None:
+            return {'html': text}
+        return self.stream_source(text, chunk_size)
+
+    def stream_source(self, text, chunk_size):
+        for i in range(0, len(text), chunk_size):
+            yield {'html': text[i:i+chunk_size]}
 
     def do_form_fill(self, page, **selectors):
         dom = page.get_dom_document()
@@ -242,10 +528,11 @@ class RolandWebExtension(RolandConfigBase):
         return notes
 
 
-    async def client_connected(self, reader, writer, *, page_id):
+    async def client_connected(self, reader, writer):
         import msgpack
-        unpacker = msgpack.Unpacker()
+        unpacker = msgpack.Unpacker(raw=True)
 
+        # connections are long-lived, with any number of requests in flight.
         while True:
             b = await reader.read(64*1024)
 
@@ -254,49 +541,87 @@ class RolandWebExtension(RolandConfigBase):
 
             unpacker.feed(b)
 
-            try:
-                request = Request(*unpacker.unpack())
-            except msgpack.OutOfData:
-                continue
-            else:
-                break
+            # each request is answered by its own task, started in the order
+            # they arrived. Streamed responses carry on between requests
+            # rather than holding up every other page of this process.
+            for request in unpacker:
+                self.loop.create_task(
+                    self.send_response(self.handle_request(Request(*request)), writer))
+
+        writer.close()
+
+    async def send_response(self, frames, writer):
+        import msgpack
 
         try:
+            for frame in frames:
+                writer.write(msgpack.dumps(frame))
+                await writer.drain()
+                # let other requests in between the chunks of a stream
+                await asyncio.sleep(0)
+        except ConnectionError as e:
+            log.info("Connection closed while responding: {}", e)
+
+    def handle_request(self, request):
+        """Yield the response frames for a request.
+
+        Commands that return a generator have their response streamed, one
+        chunk frame for each item generated.
+        """
+        try:
+            page = self.extension.get_page(request.page_id)
+            if page is None:
+                raise ValueError('No such page {}'.format(request.page_id))
+
             cmd = getattr(self, 'do_{}'.format(request.command.decode('utf8')))
             resp = cmd(
-                page=self.pages[page_id],
+                page=page,
                 **{k.decode('utf8'): v for (k, v) in request.params.items()},
             )
+
+            if inspect.isgenerator(resp):
+                for chunk in resp:
+                    yield [request.id, RESPONSE_CHUNK, chunk]
+                resp = None
         except Exception as e:
             log.exception("Error handling request {}", request)
+            yield [request.id, RESPONSE_ERROR, str(e)]
         else:
-            if not resp:
-                resp = {}
-            resp = msgpack.dumps([request.id, resp])
+            yield [request.id, RESPONSE_OK, resp or {}]
 
-            writer.write(resp)
-            await writer.drain()
-            writer.write_eof()
+    def page_path(self, page_id):
+        return runtime_path('webprocess.{}.{}'.format(self.profile, page_id))
 
     def on_page_created(self, extension, web_page):
         page_id = web_page.get_id()
-        log.info("Starting page server for {}", page_id)
-        self.pages[page_id] = web_page
-
-        path = runtime_path('webprocess.{}.{}'.format(self.profile, page_id))
+        path = self.page_path(page_id)
+        log.info("Linking page {} to {}", page_id, self.server_path)
 
         try:
             os.unlink(path)
         except FileNotFoundError:
             pass
 
-        f = asyncio.ensure_future(asyncio.start_unix_server(functools.partial(self.client_connected, page_id=page_id), path=path, loop=self.loop), loop=self.loop)
+        os.symlink(self.server_path, path)
 
-        f.add_done_callback(lambda *args: log.info("Started page server for {}", page_id))
+        # pages are looked up through the extension, rather than holding a
+        # reference, so this fires once WebKit is done with the page.
+        web_page.weak_ref(self.on_page_destroyed, page_id)
 
         web_page.connect("document-loaded", self.on_document_loaded)
         web_page.connect("send-request", self.on_send_request)
 
+    def on_page_destroyed(self, page_id):
+        log.info("Unlinking destroyed page {}", page_id)
+        self.highlight_matches.pop(page_id, None)
+        self.hint_cache.pop(page_id, None)
+        self.watched_documents.pop(page_id, None)
+
+        try:
+            os.unlink(self.page_path(page_id))
+        except FileNotFoundError:
+            pass
+
     def on_send_request(self, webpage, request, redirected_response):
         uri = request.get_uri()
 
@@ -305,13 +630,12 @@ class RolandWebExtension(RolandConfigBase):
             hsts = headers.get_one("Strict-Transport-Security")
 
             if hsts:
-                ext = self.get_extension('HSTSExtension')
-                if ext is not None:
-                    ext.add_entry(uri, hsts)
+                self.call_hook('hsts_header', uri, hsts)
 
         if not uri.startswith('http://'):
             return False
 
+        should_rewrite = False
         try:
             ext = self.get_extension('HSTSExtension')
 
@@ -319,8 +643,6 @@ class RolandWebExtension(RolandConfigBase):
                 should_rewrite = ext.check_url(uri)
         except Exception as e:
             log.exception("Error checking HSTS policy for {}", uri)
-        else:
-            should_rewrite = False
 
         if should_rewrite:
             from urllib import parse as urlparse
@@ -328,10 +650,34 @@ class RolandWebExtension(RolandConfigBase):
             request.set_uri(uri)
         return False
 
+    def watch_documents(self, page_id, documents):
+        """Drop cached hints for a page whenever one of documents, its
+        document and those of its frames, is mutated or scrolled, as the
+        hints would be stale or in the wrong place.
+
+        Called with the documents that get hinted, so pages that are never
+        hinted don't run a listener on every mutation.
+        """
+        def invalidate(target, event):
+            if not self.updating_overlay:
+                self.hint_cache.pop(page_id, None)
+
+        watched = self.watched_documents.get(page_id, [])
+        for document in documents:
+            if any(document is w for w in watched):
+                continue
+
+            document.add_event_listener_with_closure('DOMSubtreeModified', invalidate, False)
+            # scroll events don't bubble, capture them to see scrolling elements
+            document.add_event_listener_with_closure('scroll', invalidate, True)
+
+        # frames that have gone away don't need remembering
+        self.watched_documents[page_id] = list(documents)
+
     def on_document_loaded(self, webpage):
-        if self.is_enabled('HistoryManager'):
-            history_manager = self.get_extension('HistoryManager')
-            history_manager.update(webpage.get_uri())
+        page_id = webpage.get_id()
+        self.hint_cache.pop(page_id, None)
+        self.watched_documents.pop(page_id, None)
 
 
 def initialize(extension, arguments):
@@ -340,7 +686,7 @@ def initialize(extension, arguments):
     init_logging()
     log.info("Plugin initialized for {}", profile)
 
-    roland = RolandWebExtension(profile)
+    roland = RolandWebExtension(profile, extension)
 
     extension.connect('page-created', roland.on_page_created)
 
@@ -19,7 +19,8 @@ settings = {
     ),
     'zip_safe': False,
     'packages': ['roland'],
-    'scripts': ['bin/roland'],
+    'package_data': {'roland': ['hsts_preload']},
+    'scripts': ['bin/roland', 'bin/roland-update-hsts'],
 }
 
 setup(**settings)
@@ -3,6 +3,19 @@ from unittest.mock import patch, MagicMock
 import pytest
 
 
+@pytest.fixture
+def roland(tmpdir):
+    """A stand-in browser with the 'test' profile, whose config files all
+    live in tmpdir."""
+    def config_path(t, profile=''):
+        return str(tmpdir.join(t.format(profile)))
+
+    roland = MagicMock()
+    roland.profile = 'test'
+    with patch('roland.extensions.config_path', config_path):
+        yield roland
+
+
 class TestDownloadManager:
     def download_manager(self):
         from roland.extensions import DownloadManager
@@ -29,3 +42,328 @@ class TestDownloadManager:
             dm.decide_destination(download, 'foo')
 
         download.set_destination.assert_any_call('file:///path/to/downloads/' + expected_filepath)
+
+
+class TestHistoryManager:
+    def history_manager(self, roland):
+        from roland.extensions import HistoryManager
+        hm = HistoryManager(roland=roland)
+        hm.setup()
+        hm.preloaded.wait()
+        return hm
+
+    def test_migrates_legacy_history(self, roland, tmpdir):
+        import sqlite3
+        conn = sqlite3.connect(str(tmpdir.join('history.test.db')))
+        conn.execute('create table history (url text, view_count integer)')
+        conn.executemany('insert into history values (?, ?)', [
+            ('http://a/', 1), ('http://a/', 2), ('http://b/', 1)])
+        conn.commit()
+        conn.close()
+
+        hm = self.history_manager(roland)
+
+        assert hm.most_popular_urls() == ['http://a/', 'http://b/']
+
+    def test_flush_upserts_visits(self, roland):
+        hm = self.history_manager(roland)
+
+        hm.record('http://a/')
+        hm.record('http://b/')
+        hm.record('http://b/')
+        hm.flush()
+        hm.record('http://a/')
+        hm.record('http://a/')
+        hm.record('about:blank')
+        hm.flush()
+
+        rows = hm.get_history_db().execute(
+            'select url, view_count from history order by url').fetchall()
+        assert rows == [('http://a/', 3), ('http://b/', 2)]
+
+    def test_recent_visits_outrank_old_ones(self, roland):
+        from roland.extensions import FRECENCY_HALF_LIFE
+        hm = self.history_manager(roland)
+
+        with patch('time.time', return_value=1500000000):
+            for i in range(3):
+                hm.record('http://old/')
+            hm.flush()
+        with patch('time.time', return_value=1500000000 + 2 * FRECENCY_HALF_LIFE):
+            for i in range(2):
+                hm.record('http://new/')
+            hm.flush()
+
+        assert hm.most_popular_urls() == ['http://new/', 'http://old/']
+
+    def test_failed_setup_has_no_popular_urls(self, roland):
+        import sqlite3
+        from roland.extensions import HistoryManager
+        hm = HistoryManager(roland=roland)
+
+        with patch.object(HistoryManager, 'create_history_db',
+                          side_effect=sqlite3.OperationalError('database is locked')):
+            with pytest.raises(sqlite3.OperationalError):
+                hm.setup()
+
+        assert hm.most_popular_urls() == []
+
+    def test_no_popular_urls_while_loading(self, roland):
+        from roland.extensions import HistoryManager
+        hm = HistoryManager(roland=roland)
+
+        with patch.object(HistoryManager, 'preload'):
+            hm.setup()
+            hm.record('http://a/')
+
+        assert hm.most_popular_urls() == []
+
+    def test_popular_urls_update_without_flushing(self, roland):
+        hm = self.history_manager(roland)
+        hm.record('http://a/')
+        hm.flush()
+        assert hm.most_popular_urls() == ['http://a/']
+
+        hm.record('http://b/')
+        hm.record('http://b/')
+
+        assert hm.most_popular_urls() == ['http://b/', 'http://a/']
+
+
+class TestHSTSMatcher:
+    @pytest.mark.parametrize('host,expected', [
+        ('example.com', True),
+        ('www.example.com', False),
+        ('keyerror.com', True),
+        ('foo.keyerror.com', True),
+        ('a.b.keyerror.com', True),
+        ('expired.org', False),
+        ('app.dev', True),
+        ('example.org', False),
+    ])
+    def test_match(self, host, expected):
+        import datetime
+        from roland.extensions import HSTSMatcher
+        now = datetime.datetime.now()
+        later = now + datetime.timedelta(days=1)
+        matcher = HSTSMatcher([
+            ('example.com', later),
+            ('.keyerror.com', later),
+            ('.dev', later),
+            ('expired.org', now - datetime.timedelta(days=1)),
+        ])
+        assert matcher.match(host, now) == expected
+
+
+class TestHSTSPreloadList:
+    RAW = '''{
+      // comments are allowed
+      "entries": [
+        { "name": "Example.com", "mode": "force-https", "include_subdomains": true },
+        { "name": "exact.org", "mode": "force-https" },
+        { "name": "pinned.net", "pins": "google" },
+        { "name": "dev", "mode": "force-https", "include_subdomains": true }
+      ]
+    }'''
+
+    @pytest.mark.parametrize('host,expected', [
+        ('example.com', True),
+        ('www.example.com', True),
+        ('exact.org', True),
+        ('www.exact.org', False),
+        ('pinned.net', False),
+        ('app.dev', True),
+        ('example.org', False),
+        ('com', False),
+    ])
+    def test_match(self, tmpdir, host, expected):
+        from roland.extensions import HSTSPreloadList, compile_hsts_preload
+        path = tmpdir.join('hsts_preload')
+        path.write_binary(compile_hsts_preload(self.RAW))
+
+        assert HSTSPreloadList(str(path)).match(host) == expected
+
+    def test_packaged_list_used_until_updated(self, roland, tmpdir):
+        from roland.extensions import HSTSExtension, update_hsts_preload
+        source = tmpdir.join('transport_security_state_static.json')
+        source.write(self.RAW)
+
+        ext = HSTSExtension(roland=roland)
+        ext.setup()
+        assert ext.check_url('http://github.com/')
+        assert not ext.check_url('http://www.example.com/')
+
+        assert update_hsts_preload(str(tmpdir.join('hsts_preload')), str(source)) == 3
+        ext.next_refresh = 0
+        assert ext.check_url('http://www.example.com/')
+        assert not ext.check_url('http://github.com/')
+
+    def test_rejects_other_files(self, tmpdir):
+        from roland.extensions import HSTSPreloadList
+        path = tmpdir.join('hsts_preload')
+        path.write_binary(b'not a preload list\n')
+
+        with pytest.raises(ValueError):
+            HSTSPreloadList(str(path))
+
+
+class TestHSTSExtension:
+    @pytest.fixture
+    def hsts_extension(self, roland):
+        from roland.extensions import HSTSExtension
+        ext = HSTSExtension(roland=roland)
+        ext.setup()
+        return ext
+
+    def test_coalesces_headers(self, hsts_extension):
+        ext = hsts_extension
+
+        with patch('roland.extensions.parse_dict_header', return_value={'max-age': '600'}) as parse:
+            for i in range(200):
+                ext.add_entry('https://example.com/{}.js'.format(i), 'max-age=600')
+            ext.add_entry('https://example.org/', 'max-age=600')
+        assert parse.call_count == 2
+        assert ext.check_url('http://example.com/')
+
+        ext.flush()
+        rows = ext.get_hsts_db().execute('select domain from hsts order by domain').fetchall()
+        assert rows == [('example.com',), ('example.org',)]
+
+    def test_migrates_legacy_preload_rows(self, roland, tmpdir):
+        import datetime
+        import sqlite3
+        from roland.extensions import HSTSExtension
+        now = datetime.datetime.now()
+        preloaded = now + datetime.timedelta(days=365)
+
+        conn = sqlite3.connect(str(tmpdir.join('hsts.test.db')))
+        conn.execute('create table hsts (domain text unique, expiry timestamp)')
+        conn.executemany('insert into hsts values (?, ?)', [
+            ('preloaded{}.com'.format(i), preloaded) for i in range(2000)])
+        conn.execute('insert into hsts values (?, ?)', ('example.com', now + datetime.timedelta(days=1)))
+        conn.commit()
+        conn.close()
+
+        # without a preload list, the legacy rows are all there is
+        with patch('roland.extensions.HSTS_PRELOAD_PACKAGED', str(tmpdir.join('missing'))):
+            ext = HSTSExtension(roland=roland)
+            ext.setup()
+        assert ext.preload is None
+        assert ext.get_hsts_db().execute('select count(*) from hsts').fetchone() == (2001,)
+        assert ext.check_url('http://preloaded0.com/')
+
+        ext = HSTSExtension(roland=roland)
+        ext.setup()
+
+        assert ext.get_hsts_db().execute('select domain from hsts').fetchall() == [('example.com',)]
+        assert ext.check_url('http://example.com/')
+        assert not ext.check_url('http://preloaded0.com/')
+
+    def test_refresh_reads_new_rows_only(self, hsts_extension):
+        import datetime
+        ext = hsts_extension
+        later = datetime.datetime.now() + datetime.timedelta(days=1)
+        assert not ext.check_url('http://example.com/')
+
+        # written by another process
+        with ext.get_hsts_db() as conn:
+            conn.execute('insert into hsts (domain, expiry) values (?, ?)', ('example.com', later))
+        ext.loaded_mtime = None
+        ext.next_refresh = 0
+
+        with patch('roland.extensions.HSTSMatcher.add') as add:
+            ext.check_url('http://example.org/')
+        add.assert_called_once_with('example.com', later)
+
+    def test_maintenance_purges_expired(self, hsts_extension):
+        import datetime
+        ext = hsts_extension
+        now = datetime.datetime.now()
+
+        with ext.get_hsts_db() as conn:
+            conn.executemany('insert into hsts (domain, expiry) values (?, ?)', [
+                ('expired{}.com'.format(i), now - datetime.timedelta(days=1)) for i in range(1000)])
+            conn.execute('insert into hsts (domain, expiry) values (?, ?)',
+                         ('example.com', now + datetime.timedelta(days=1)))
+
+        ext.maintain()
+
+        rows = ext.get_hsts_db().execute('select domain from hsts').fetchall()
+        assert rows == [('example.com',)]
+        assert ext.stats['purged'] == 1000
+        assert ext.stats['entries'] == 1
+        assert ext.stats['vacuumed']
+
+
+class TestPasswordManagerExtension:
+    @pytest.fixture
+    def password_manager(self, roland):
+        from roland.extensions import PasswordManagerExtension
+
+        # stand-in cipher, records only decrypt under the key they were
+        # encrypted with
+        def encrypt(self, raw):
+            return self.key[:4] + raw
+
+        def decrypt(self, enc):
+            return enc[4:] if enc[:4] == self.key[:4] else b'garbage'
+
+        ext = PasswordManagerExtension(roland=roland)
+        with patch.object(PasswordManagerExtension, 'encrypt', encrypt), \
+                patch.object(PasswordManagerExtension, 'decrypt', decrypt):
+            yield ext
+
+    def test_indexes_legacy_records(self, password_manager, tmpdir):
+        import hashlib
+        ext = password_manager
+        key = hashlib.sha256(b'hunter2').digest()
+
+        conn = ext.get_password_db()
+        conn.execute('create table managed '
+                     '(id integer primary key, last_used timestamp, '
+                     ' description text, domain text, data text)')
+        conn.executemany(
+            'insert into managed (last_used, description, domain, data) values (?, ?, ?, ?)', [
+                (None, key[:4] + b'sentinel', key[:4] + b'!!frozen-brains-tell-no-tales!!', key[:4] + b'\x80'),
+                (None, key[:4] + b'a', key[:4] + b'example.com', key[:4] + b'\x81\xa1u\xa1a'),
+            ])
+        conn.commit()
+        conn.close()
+
+        ext.setup()
+        with pytest.raises(ValueError):
+            ext.test_password('wrong')
+        ext.test_password('hunter2')
+
+        ext.key = key
+        ext.index_domains()
+        ext.save_form('example.org', {b'u': b'b'})
+
+        assert [r.form_data for r in ext.get_for_domain(b'example.com')] == [{b'u': b'a'}]
+        assert [r.form_data for r in ext.get_for_domain(b'example.org')] == [{b'u': b'b'}]
+        assert ext.get_password_db().execute(
+            'select count(*) from managed where domain_hash is null').fetchone() == (0,)
+
+        ext.key = None
+        with pytest.raises(ValueError):
+            ext.test_password('wrong')
+        ext.test_password('hunter2')
+
+    def test_caches_decrypted_records(self, password_manager):
+        import hashlib
+        ext = password_manager
+        ext.setup()
+        ext.key = hashlib.sha256(b'hunter2').digest()
+        ext.save_form('example.com', {b'u': b'a'})
+
+        first = ext.get_for_domain(b'example.com')
+        with patch.object(ext, 'get_password_db', side_effect=AssertionError):
+            assert ext.get_for_domain(b'example.com') == first
+
+        ext.update_last_used(first[0].id)
+        ext.save_form('example.com', {b'u': b'b'})
+        assert [r.form_data for r in ext.get_for_domain(b'example.com')] == [{b'u': b'b'}, {b'u': b'a'}]
+
+        ext.lock()
+        assert ext.key is None
+        assert not ext.cache
@@ -15,3 +15,144 @@ import pytest
 def test_pretty_size(bytecount, expected_output):
     from roland.utils import get_pretty_size
     assert get_pretty_size(bytecount) == expected_output
+
+
+def test_highlight_source():
+    pytest.importorskip('pygments')
+    from roland.utils import highlight_source
+
+    highlighted = highlight_source('<a href="/">home</a>')
+    assert highlighted.startswith('<!DOCTYPE')
+    assert 'home' in highlighted
+
+
+SUGGESTIONS = [
+    'https://example.com/',
+    'http://Example.org/index.html',
+    'https://python.org/',
+    'about:blank',
+    'https://docs.python.org/3/',
+]
+
+
+@pytest.mark.parametrize('text,beginning,case_sensitive,expected', [
+    ('https', True, False, [SUGGESTIONS[0], SUGGESTIONS[2], SUGGESTIONS[4]]),
+    ('http://e', True, False, [SUGGESTIONS[1]]),
+    ('http://e', True, True, []),
+    ('python', False, False, [SUGGESTIONS[2], SUGGESTIONS[4]]),
+    ('ex', False, False, [SUGGESTIONS[0], SUGGESTIONS[1]]),
+    ('Example', False, True, [SUGGESTIONS[1]]),
+    ('', True, False, SUGGESTIONS),
+    ('nothing', False, False, []),
+])
+def test_completion_index_search(text, beginning, case_sensitive, expected):
+    from roland.utils import CompletionIndex
+    index = CompletionIndex(SUGGESTIONS, case_sensitive=case_sensitive)
+    assert index.search(text, beginning=beginning) == expected
+
+
+def test_completion_index_narrows_and_extends():
+    from roland.utils import CompletionIndex
+    index = CompletionIndex(SUGGESTIONS)
+
+    assert index.search('y', limit=1) == [SUGGESTIONS[2]]
+    assert index.search('py') == [SUGGESTIONS[2], SUGGESTIONS[4]]
+    assert index.search('pyt.org') == []
+    assert index.search('org') == SUGGESTIONS[1:3] + SUGGESTIONS[4:]
+
+    index.extend(['https://pypi.org/'])
+    assert index.search('py') == [SUGGESTIONS[2], SUGGESTIONS[4], 'https://pypi.org/']
+
+
+@pytest.mark.parametrize('pattern,expected', [
+    ('python*org', [SUGGESTIONS[2], SUGGESTIONS[4]]),
+    ('docs', [SUGGESTIONS[4]]),
+    ('[ab]bout', [SUGGESTIONS[3]]),
+    ('?xample', [SUGGESTIONS[0], SUGGESTIONS[1]]),
+])
+def test_completion_index_glob(pattern, expected):
+    from roland.utils import CompletionIndex
+    assert CompletionIndex(SUGGESTIONS).glob(pattern) == expected
+
+
+def test_fuzzy_score():
+    from roland.utils import fuzzy_score
+    assert fuzzy_score('git', 'github.com') > fuzzy_score('git', 'go.in.the.com')
+    assert fuzzy_score('gh', 'go.home.com') > fuzzy_score('gh', 'algorithm')
+    assert fuzzy_score('hg', 'github.com') is None
+
+
+def test_completion_index_fuzzy():
+    from roland.utils import CompletionIndex
+    index = CompletionIndex([
+        'https://docs.python.org/3/',
+        'https://dpaste.org/',
+        'https://pypi.org/',
+        'https://python.org/',
+    ])
+
+    assert index.fuzzy('pyorg') == [
+        'https://pypi.org/', 'https://python.org/', 'https://docs.python.org/3/']
+    assert index.fuzzy('pyorg', limit=1) == ['https://pypi.org/']
+    assert index.fuzzy('dpy') == ['https://docs.python.org/3/']
+    assert index.fuzzy('') == index.suggestions
+
+
+def test_completion_index_abandoned_query():
+    from roland.utils import CompletionIndex, run_steps
+    index = CompletionIndex(SUGGESTIONS)
+    index.chunk_size = 2
+
+    steps = index.iter_search('python')
+    next(steps)
+    del steps
+
+    assert run_steps(index.iter_search('org')) == SUGGESTIONS[1:3] + SUGGESTIONS[4:]
+    assert run_steps(index.iter_fuzzy('pyorg', limit=1)) == [SUGGESTIONS[2]]
+    assert run_steps(index.iter_glob('*.org/', limit=2)) == SUGGESTIONS[1:3]
+
+
+def test_extension_lookup_and_hooks():
+    from roland.utils import RolandConfigBase
+
+    class First:
+        sort_order = 1
+
+        def __init__(self, roland):
+            roland.subscribe('visit', self.on_visit)
+            self.visits = []
+
+        def on_visit(self, url):
+            self.visits.append(url)
+
+    class Second(First):
+        sort_order = 0
+
+    base = RolandConfigBase()
+    base.set_extensions([First, Second])
+
+    assert [type(ext) for ext in base.extensions] == [Second, First]
+    assert isinstance(base.get_extension('First'), First)
+    assert base.get_extension(Second) is base.extensions[0]
+    assert not base.is_enabled('Third')
+
+    assert base.has_subscribers('visit')
+    assert not base.has_subscribers('close')
+    base.call_hook('visit', 'http://a/')
+    base.call_hook('close')
+    assert [ext.visits for ext in base.extensions] == [['http://a/'], ['http://a/']]
+
+
+def test_completion_index_partially_indexed():
+    from roland.utils import CompletionIndex
+    index = CompletionIndex(SUGGESTIONS)
+    index.trigram_threshold = 0
+    expected = [SUGGESTIONS[2], SUGGESTIONS[4]]
+
+    assert index.needs_indexing()
+    assert index.search('python') == expected
+    while index.index_step(count=2):
+        index.last_query = None
+        assert index.search('python') == expected
+    assert index.indexed == len(SUGGESTIONS)
+    assert index.search('thon.o') == expected